@@ -1,13 +1,41 @@
 
+import functools
 import io
 import os
-import unicodedata
-from typing import Any, Dict, List, Optional, Tuple
+import tempfile
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import streamlit as st
 
+# Copy-on-write: filtros, renomeações e fatias compartilham os dados do frame de
+# origem; só a coluna efetivamente alterada é duplicada.
+pd.set_option("mode.copy_on_write", True)
+
+from armazem import ARMAZEM_DADOS, CACHE_DERIVADOS, CACHE_EXPORTACOES, CACHES, LEITURAS_PLANILHAS, tamanho_bytes
+from diagnostico import (
+    DIAGNOSTICO_ATIVO, HISTORICO_MEMORIA, INTERVALO_MEMORIA, LATENCIAS_ATIVO, PERCENTIS_LATENCIA, PERFIL_ATIVO, REGISTRO_LATENCIAS,
+    Perfilador, Rastreador, contar_linhas, etapa, memoria_processo, percentis_latencia,
+)
+from ingestao import (
+    COL_EQUIPE_COMPLETA, COL_FAMILIA_VINCULADA, COL_STATUS_DOC, COL_TEMPO_SEM_ATUALIZAR,
+    COL_UNIDADE, TIPO_CIDADAOS, TIPO_DOMICILIOS, TIPO_PRODUTIVIDADE, ResultadoLeitura,
+    concatenar_planilhas, existe_cache_parquet, hash_conteudo, processar_planilha, processar_planilhas,
+)
+from motor import (
+    COLUNAS_CUBO_PRODUCAO, LINHAS_MAXIMAS_XLSX, ORDEM_CPF, ORDEM_TEMPO, calcular_vinculos, categorias_dos_tipos,
+    coluna_tipo_consulta, crosstab_observado, enriquecer_vinculos, escrever_csv, escrever_xlsx, fatiar_periodo,
+    filtrar_cubo_cidadaos, inferir_municipio, intervalo_datas, montar_cubo_cidadaos, montar_cubo_producao,
+    montar_matriz_tipos, parametros_do_municipio, perfil_unidades, remover_vazios, resumo_unidades,
+    scorecard_unidades, tabela_categorias, tabela_consultas_esb, tabela_cubo_cidadaos, tabela_parametros,
+    tabela_tipos_atendimento,
+)
+
 # --- CONFIGURAÇÃO DA PÁGINA (DEVE SER O 1º COMANDO STREAMLIT) ---
 st.set_page_config(page_title="Dashboard de Gestão APS", layout="wide")
 
@@ -15,116 +43,116 @@ st.set_page_config(page_title="Dashboard de Gestão APS", layout="wide")
 # 1. CONSTANTES E CONFIGURAÇÕES
 # ==============================================================================
 
-COL_STATUS_DOC = 'STATUS DOCUMENTO'
-COL_TEMPO_SEM_ATUALIZAR = 'TEMPO SEM ATUALIZAR'
-COL_UNIDADE = 'UNIDADE DE SAÚDE'
-COL_NOME_EQUIPE = 'NOME EQUIPE'
-COL_INE = 'INE'
-COL_CIDADAO = 'CIDADÃO'
-COL_EQUIPE_COMPLETA = 'EQUIPE_COMPLETA'
-COL_FAMILIA_VINCULADA = 'TEM FAMÍLIA VÍNCULADA?'
-DOM_COL_UNIDADE = 'Estabelecimento'
-
 CONFIG_VISUAL: Dict[str, Any] = {
     'cores_status': {
         '✅ Dentro do Parâmetro': '#28a745',
         '⚠️ Acima do Parâmetro': '#ffc107',
         '🚨 ACIMA DO LIMITE MÁXIMO': '#dc3545'
     },
-    'ordem_tempo': ['ATÉ 4 MESES', '5 A 12 MESES', '13 A 24 MESES', 'MAIS DE 2 ANOS'],
-    'ordem_cpf': ['COM CPF', 'SEM CPF']
+    'ordem_tempo': ORDEM_TEMPO,
+    'ordem_cpf': ORDEM_CPF
 }
 
+# Dados de um conjunto de uploads, compartilhados (somente leitura) pelas sessões via ARMAZEM_DADOS
+class DadosUpload(NamedTuple):
+    cid: Optional[pd.DataFrame]
+    dom: Optional[pd.DataFrame]
+    prod: Optional[pd.DataFrame]
+    cubo_cid: Optional[Tuple[pd.DataFrame, pd.Series, int]]
+    erros: Tuple[str, ...]
+    nomes: Tuple[str, ...]  # nomes dos arquivos (identificam o município no painel de memória)
+
+# Acima deste nº de linhas a exportação é feita em streaming (arquivo temporário, memória constante)
+LIMITE_LINHAS_EXPORTACAO = int(os.environ.get('APS_LIMITE_EXPORTACAO', 100_000))
+
 # ==============================================================================
 # 2. FUNÇÕES UTILITÁRIAS E CARREGAMENTO DE DADOS
 # ==============================================================================
 
-def _normalize_text(text: str) -> str:
-    if not isinstance(text, str): return ""
-    return unicodedata.normalize("NFKD", text).encode("ASCII", "ignore").decode().upper().strip()
-
-@st.cache_data
+@st.cache_data(max_entries=1)
 def carregar_parametros() -> pd.DataFrame:
+    """Parâmetros de todos os municípios (ver `motor.PARAMETROS_POR_MUNICIPIO`)."""
+    return tabela_parametros()
+
+def hash_tabela(df: pd.DataFrame) -> str:
+    """Hash do conteúdo de uma tabela: valores, nomes e tipos das colunas."""
+    valores = pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
+    return hash_conteudo(valores + repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode())
+
+def _gerar_excel(df: pd.DataFrame) -> bytes:
     """
-    Carrega os parâmetros de todos os municípios. A identificação de equipes EAP
-    é feita pelo NÚMERO DE INE para máxima precisão.
-    
-    !!!! ATENÇÃO !!!!
-    É CRÍTICO que você edite a seção `eap_por_ine` abaixo, substituindo
-    os INEs de exemplo pelos INEs REAIS das suas equipes EAP.
+    Bytes do xlsx de uma tabela, em cache pelo hash do conteúdo. Roda no clique
+    do download, depois da execução do script: com o diagnóstico ligado, o tempo
+    vai para o JSONL numa linha própria (evento 'download').
     """
-    PARAMETROS_POR_MUNICIPIO = {
-        # --- MUNICÍPIOS COM EQUIPES EAP (CONFIGURAR AQUI) ---
-        'ALHANDRA-PB':            {'parametro_esf': 2500, 'limite_esf': 3750, 'eap_por_ine': {
-                                      '0009999': {'tipo': '30', 'parametro': 1875, 'limite_maximo': 2813} # SUBSTITUIR PELO INE REAL
-                                  }},
-        'MACAÍBA-RN':             {'parametro_esf': 2750, 'limite_esf': 4125, 'eap_por_ine': {
-                                      '0001234': {'tipo': '20', 'parametro': 1375, 'limite_maximo': 2063}, # SUBSTITUIR PELO INE REAL
-                                      '0005678': {'tipo': '30', 'parametro': 1875, 'limite_maximo': 2813}  # SUBSTITUIR PELO INE REAL
-                                  }},
-        'VALENÇA-RJ':             {'parametro_esf': 2750, 'limite_esf': 4125, 'eap_por_ine': {
-                                      '0004321': {'tipo': '20', 'parametro': 1375, 'limite_maximo': 2063} # SUBSTITUIR PELO INE REAL
-                                  }},
-        
-        # --- MUNICÍPIOS APENAS COM EQUIPES ESF ---
-        'ÁGUA PRETA-PE':          {'parametro_esf': 2500, 'limite_esf': 3750},
-        'ÁGUAS BELAS-PE':         {'parametro_esf': 2500, 'limite_esf': 3750},
-        'ALTO DO RODRIGUES-RN':   {'parametro_esf': 2000, 'limite_esf': 3000},
-        'APODI-RN':               {'parametro_esf': 2500, 'limite_esf': 3750},
-        'ARAPONGA-MG':            {'parametro_esf': 2000, 'limite_esf': 3000},
-        'AREIA-PB':               {'parametro_esf': 2500, 'limite_esf': 3750},
-        'AÇU-RN':                 {'parametro_esf': 2750, 'limite_esf': 4125},
-        'BRUMADO-BA':             {'parametro_esf': 2750, 'limite_esf': 4125},
-        'CAAPORÃ-PB':             {'parametro_esf': 2500, 'limite_esf': 3750},
-        'CALDAS BRANDÃO-PB':      {'parametro_esf': 2000, 'limite_esf': 3000},
-        'CANAÃ-MG':               {'parametro_esf': 2000, 'limite_esf': 3000},
-        'CARNAUBAIS-RN':          {'parametro_esf': 2000, 'limite_esf': 3000},
-        'CONDE-PB':               {'parametro_esf': 2500, 'limite_esf': 3750},
-        'CORDEIRO-RJ':            {'parametro_esf': 2500, 'limite_esf': 3750},
-        'FERNANDO PEDROZA-RN':    {'parametro_esf': 2000, 'limite_esf': 3000},
-        'GROSSOS-RN':             {'parametro_esf': 2000, 'limite_esf': 3000},
-        'GUARABIRA-PB':           {'parametro_esf': 2750, 'limite_esf': 4125},
-        'ITABAIANA-PB':           {'parametro_esf': 2500, 'limite_esf': 3750},
-        'ITAPOROROCA-PB':         {'parametro_esf': 2000, 'limite_esf': 3000},
-        'ITATUBA-PB':             {'parametro_esf': 2000, 'limite_esf': 3000},
-        'MOGEIRO-PB':             {'parametro_esf': 2000, 'limite_esf': 3000},
-        'PATU-RN':                {'parametro_esf': 2000, 'limite_esf': 3000},
-        'PITIMBU-PB':             {'parametro_esf': 2000, 'limite_esf': 3000},
-        'PAULA CÂNDIDO-MG':       {'parametro_esf': 2000, 'limite_esf': 3000},
-        'PEDRO VELHO-RN':         {'parametro_esf': 2000, 'limite_esf': 3000},
-        'PENDÊNCIAS-RN':          {'parametro_esf': 2000, 'limite_esf': 3000},
-        'POÇO BRANCO-RN':         {'parametro_esf': 2000, 'limite_esf': 3000},
-        'SANTA RITA-PB':          {'parametro_esf': 3000, 'limite_esf': 4500},
-        'SÃO JOSÉ DE UBÁ-RJ':     {'parametro_esf': 2000, 'limite_esf': 3000},
-        'SÃO MIGUEL DO ANTA-MG':  {'parametro_esf': 2000, 'limite_esf': 3000},
-        'TIBAU-RN':               {'parametro_esf': 2000, 'limite_esf': 3000},
-        'VIÇOSA-MG':              {'parametro_esf': 2750, 'limite_esf': 4125},
-        'VIÇOSA DO CEARÁ-CE':     {'parametro_esf': 2750, 'limite_esf': 4125},
-    }
-    
-    data_list = []
-    for municipio_uf, params in PARAMETROS_POR_MUNICIPIO.items():
-        try:
-            nome, uf = municipio_uf.rsplit('-', 1)
-            row = {
-                'MUNICIPIO': nome, 'UF': uf,
-                'PARAMETRO_ESF': params['parametro_esf'],
-                'LIMITE_ESF': params['limite_esf'],
-                'EAP_POR_INE': params.get('eap_por_ine', {})
-            }
-            data_list.append(row)
-        except ValueError:
-            print(f"Aviso: Chave de município mal formatada e ignorada: {municipio_uf}")
-    return pd.DataFrame(data_list)
-
-def exportar_excel(df: pd.DataFrame, nome_arquivo: str):
-    buffer = io.BytesIO()
-    df.to_excel(buffer, index=False, sheet_name="Dados")
+    gerado = []
+    def gerar() -> bytes:
+        gerado.append(True)
+        buffer = io.BytesIO()
+        df.to_excel(buffer, index=False, sheet_name="Dados", engine="xlsxwriter")
+        return buffer.getvalue()
+    rastreador = Rastreador() if DIAGNOSTICO_ATIVO else None
+    with rastreador or nullcontext():
+        with etapa("exportacao.xlsx", len(df)) as registro:
+            dados = CACHE_EXPORTACOES.obter(hash_tabela(df), gerar)
+            registro.cache = 'falta' if gerado else 'acerto'
+    if rastreador is not None: rastreador.gravar(evento='download')
+    return dados
+
+def _gerar_arquivo_streaming(obter_df: Callable[[], pd.DataFrame], formato: str) -> bytes:
+    """Escreve a tabela num arquivo temporário e devolve só os bytes finais."""
+    escritor = escrever_xlsx if formato == 'xlsx' else escrever_csv
+    with tempfile.TemporaryDirectory(prefix="aps_exportacao_") as pasta:
+        caminho = os.path.join(pasta, f"dados.{formato}")
+        escritor(obter_df(), caminho)
+        with open(caminho, 'rb') as arquivo: return arquivo.read()
+
+def exportar_streaming(obter_df: Callable[[], pd.DataFrame], n_linhas: int, nome_arquivo: str):
+    """
+    Botões de download para tabelas grandes. `obter_df` só é chamado no clique e
+    o arquivo é escrito em blocos; o xlsx só é oferecido se couber numa planilha.
+    """
+    base = os.path.splitext(nome_arquivo)[0]
+    if n_linhas < LINHAS_MAXIMAS_XLSX:
+        st.download_button(
+            label="⬇️ Baixar em Excel", data=lambda: _gerar_arquivo_streaming(obter_df, 'xlsx'),
+            file_name=f"{base}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
     st.download_button(
-        label="⬇️ Baixar em Excel", data=buffer.getvalue(),
-        file_name=nome_arquivo, mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        label="⬇️ Baixar em CSV", data=lambda: _gerar_arquivo_streaming(obter_df, 'csv'),
+        file_name=f"{base}.csv", mime="text/csv"
     )
 
+def exportar_excel(df: pd.DataFrame, nome_arquivo: str):
+    with etapa("exportar_excel", len(df)):
+        if len(df) > LIMITE_LINHAS_EXPORTACAO:
+            exportar_streaming(lambda: df, len(df), nome_arquivo)
+            return
+        # O xlsx só é gerado quando o usuário pede o download (data como função)
+        st.download_button(
+            label="⬇️ Baixar em Excel", data=lambda: _gerar_excel(df),
+            file_name=nome_arquivo, mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+def exibir_grafico(fig):
+    """Gráfico Plotly na largura da página; a serialização da figura entra no diagnóstico."""
+    with etapa("grafico.exibir"):
+        st.plotly_chart(fig, use_container_width=True)
+
+def fragmento_medido(render: Callable) -> Callable:
+    """
+    Mede as reexecuções isoladas de uma aba em fragmento (filtros dela), que não
+    passam por `run()`: entram no registro de latência como '<aba>.fragmento'.
+    """
+    @functools.wraps(render)
+    def executar(self, *args, **kwargs):
+        if self._em_execucao or not LATENCIAS_ATIVO: return render(self, *args, **kwargs)
+        inicio = time.perf_counter()
+        resultado = render(self, *args, **kwargs)
+        self._registrar_latencia(time.perf_counter() - inicio, view=f"{st.session_state.get('view')}.fragmento")
+        return resultado
+    return executar
+
 def render_alert_panel(message: str, type: str = "info"):
     colors = {"info": "#3281ed", "success": "#23914b", "warning": "#ae8602", "critical": "#cb3b36"}
     st.markdown(f'<div style="background:{colors[type]};padding:13px 15px;border-radius:12px;margin-bottom:10px;color:#fff;">{message}</div>', unsafe_allow_html=True)
@@ -134,17 +162,34 @@ def render_alert_panel(message: str, type: str = "info"):
 # ==============================================================================
 
 class DashboardAPS:
+    # Grafo dos dados derivados: nome -> (método que o calcula, filtros da chave de cache, dependências).
+    # Cada nó só é calculado quando uma aba o pede, e fica em cache por uploads + filtros.
+    GRAFO_DERIVADOS: Dict[str, Tuple[str, Tuple[str, ...], Tuple[str, ...]]] = {
+        'cubo_cid_filtrado': ('_filtrar_cubo_cidadaos', ('unidade',), ()),
+        'total_cid_filtrado': ('_contar_cidadaos_filtrados', ('unidade',), ()),
+        'df_vinculos': ('_calcular_vinculos', ('unidade', 'parametros'), ('cubo_cid_filtrado',)),
+        'df_dom_filtrado': ('_filtrar_domicilios', (), ()),
+        'df_prod_filtrado': ('_filtrar_producao', ('periodo',), ()),
+        'cubo_prod': ('_montar_cubo_producao', ('periodo',), ('df_prod_filtrado',)),
+        'matriz_tipos_atendimento': ('_montar_matriz_tipos', ('periodo',), ('df_prod_filtrado',)),
+    }
+
     def __init__(self):
         if "logged_in" not in st.session_state: st.session_state.logged_in = False
         if "view" not in st.session_state: st.session_state.view = "menu"
         self.df_parametros = carregar_parametros()
-        self.df_cid_bruto = self.df_cid_filtrado = self.df_dom_bruto = self.df_dom_filtrado = self.df_prod_bruto = self.df_prod_filtrado = self.df_vinculos = None
+        self.df_cid_bruto = self.cubo_cid = self.cubo_cid_filtrado = self.cid_unicos_por_unidade = self.df_dom_bruto = self.df_dom_filtrado = self.df_prod_bruto = self.df_prod_filtrado = self.df_vinculos = self.cubo_prod = self.matriz_tipos_atendimento = None
         self.municipio_selecionado: Optional[str] = None
         self.unidade_selecionada: str = 'Todas'
         self.periodo_selecionado: Optional[Tuple] = None
+        self.total_cid_unicos = self.total_cid_filtrado = 0
+        self.fingerprint_dados: Optional[str] = None
         self.parametro_oficial = self.limite_oficial = 0
         self.parametros_municipio_atual = {}
         self.grupo_principal: str = COL_UNIDADE
+        self._materializados: set = set()
+        self.abas: List[str] = []  # views do painel (chaves do view_map), para a página de latência
+        self._em_execucao = False  # execução completa em andamento (fora dela, só um fragmento reexecuta)
 
     def _check_credentials(self, username, password) -> bool:
         return username == "admin" and password == "admin"
@@ -249,131 +294,157 @@ class DashboardAPS:
             st.markdown('</div>', unsafe_allow_html=True)
     
     @staticmethod
-    @st.cache_data
-    def _ler_planilha_cidadaos(file):
-        try:
-            df = pd.read_excel(io.BytesIO(file.getvalue()), sheet_name='DETALHADO')
-            df.columns = df.columns.str.strip()
-            req = [COL_STATUS_DOC, COL_TEMPO_SEM_ATUALIZAR, COL_UNIDADE, COL_NOME_EQUIPE, COL_INE, COL_CIDADAO]
-            if not all(c in df.columns for c in req): return None
-            df = df[req].dropna(subset=[COL_UNIDADE, COL_NOME_EQUIPE, COL_INE, COL_CIDADAO])
-            df[COL_TEMPO_SEM_ATUALIZAR] = df[COL_TEMPO_SEM_ATUALIZAR].str.upper()
-            df[COL_STATUS_DOC] = df[COL_STATUS_DOC].str.upper()
-            df[COL_INE] = df[COL_INE].astype(str).str.strip()
-            df[COL_EQUIPE_COMPLETA] = df[COL_NOME_EQUIPE].str.strip() + ' - ' + df[COL_INE]
-            return df
-        except Exception as e:
-            st.error(f"Erro ao ler planilha de cidadãos: {e}")
-            return None
+    def _liberar_uploads():
+        """Solta a referência da sessão aos dados do armazém (que podem então ser descartados) e os digests dos uploads."""
+        st.session_state.pop("dados_upload", None)
+        st.session_state.pop("digests_upload", None)
 
     @staticmethod
-    @st.cache_data
-    def _ler_planilha_domicilios(file):
-        try:
-            df = pd.read_excel(io.BytesIO(file.getvalue()), sheet_name='DETALHADO')
-            df.columns = df.columns.str.strip()
-            req = [DOM_COL_UNIDADE, 'INE', COL_TEMPO_SEM_ATUALIZAR, COL_FAMILIA_VINCULADA]
-            if not all(c in df.columns for c in req): return None
-            df['INE'] = df['INE'].astype(str)
-            df['ESTABELECIMENTO_COMPLETO'] = df[DOM_COL_UNIDADE] + ' - ' + df['INE']
-            return df[['ESTABELECIMENTO_COMPLETO', COL_TEMPO_SEM_ATUALIZAR, COL_FAMILIA_VINCULADA]].copy()
-        except Exception: return None
+    def _hash_upload(file) -> str:
+        """SHA-256 do conteúdo do arquivo, calculado uma única vez por upload na sessão."""
+        digests = st.session_state.setdefault("digests_upload", {})
+        if file.file_id not in digests: digests[file.file_id] = hash_conteudo(file.getvalue())
+        return digests[file.file_id]
 
     @staticmethod
-    @st.cache_data
-    def _ler_planilha_produtividade(file):
-        try:
-            df = pd.read_excel(io.BytesIO(file.getvalue()))
-            df.columns = df.columns.str.strip()
-            if 'DATA' in df.columns: df['DATA'] = pd.to_datetime(df['DATA'], errors='coerce')
-            return df
-        except Exception: return None
+    def _ler_uploads(digests: List[str], files: List[Any]) -> DadosUpload:
+        """
+        Lê os uploads, concatena as planilhas de cada tipo e monta o cubo dos
+        cidadãos. Arquivos fora do cache em disco vão juntos para o pool de processos.
+        """
+        arquivos = dict(zip(digests, files))
+
+        def ler(novos: List[str]) -> List[ResultadoLeitura]:
+            pendentes = [d for d in novos if not existe_cache_parquet(d)]
+            resultados = {}
+            if len(pendentes) > 1:
+                resultados = dict(zip(pendentes, processar_planilhas([(d, arquivos[d].getvalue()) for d in pendentes])))
+            return [resultados.get(d) or processar_planilha(d, arquivos[d].getvalue()) for d in novos]
+
+        lidos = LEITURAS_PLANILHAS.executar_lote(digests, ler)
+        listas: Dict[str, List[pd.DataFrame]] = {TIPO_CIDADAOS: [], TIPO_DOMICILIOS: [], TIPO_PRODUTIVIDADE: []}
+        erros = []
+        for digest in digests:
+            tipo, df, erro = lidos[digest]
+            if erro: erros.append(erro)
+            if df is not None: listas[tipo].append(df)
+        cid, dom, prod = (concatenar_planilhas(listas[tipo]) if listas[tipo] else None for tipo in (TIPO_CIDADAOS, TIPO_DOMICILIOS, TIPO_PRODUTIVIDADE))
+        return DadosUpload(cid, dom, prod, montar_cubo_cidadaos(cid) if cid is not None else None, tuple(erros), tuple(f.name for f in files))
 
     def _processar_uploads(self, files: List[any]):
-        cid_list, dom_list, prod_list = [], [], []
-        for f in files:
-            df_cid = self._ler_planilha_cidadaos(f)
-            if df_cid is not None: cid_list.append(df_cid); continue
-            df_dom = self._ler_planilha_domicilios(f)
-            if df_dom is not None: dom_list.append(df_dom); continue
-            df_prod = self._ler_planilha_produtividade(f)
-            if df_prod is not None and 'EQUIPE' in df_prod.columns: prod_list.append(df_prod)
-        if cid_list: self.df_cid_bruto = pd.concat(cid_list, ignore_index=True)
-        if dom_list: self.df_dom_bruto = pd.concat(dom_list, ignore_index=True)
-        if prod_list: self.df_prod_bruto = pd.concat(prod_list, ignore_index=True)
-    
-    def _get_parametros_por_ine(self, ine: str) -> dict:
-        """Busca os parâmetros de uma equipe pelo seu INE. Retorna os parâmetros de ESF como padrão."""
-        eap_map = self.parametros_municipio_atual.get('EAP_POR_INE', {})
-        
-        if ine in eap_map:
-            return eap_map[ine]
-        
-        return {
-            'tipo': 'ESF',
-            'parametro': self.parametro_oficial,
-            'limite_maximo': self.limite_oficial
-        }
-
-    def _calcular_vinculos(self) -> pd.DataFrame:
-        """Calcula vínculos, identifica tipo de equipe via INE e formata os dados."""
-        vinculos_df = self.df_cid_filtrado.groupby([COL_UNIDADE, COL_EQUIPE_COMPLETA])[COL_CIDADAO].count().reset_index()
-        vinculos_df.columns = ['Unidade de Saúde', 'Equipe Original', 'Nº de Pessoas Vinculadas']
-        
-        vinculos_df['INE'] = vinculos_df['Equipe Original'].str.split(' - ').str[-1].str.strip()
-        
-        params_series = vinculos_df['INE'].apply(self._get_parametros_por_ine)
-        params_df = pd.json_normalize(params_series)
-        vinculos_df = vinculos_df.join(params_df)
-        
-        vinculos_df.rename(columns={
-            'tipo': 'Tipo de Equipe',
-            'parametro': 'Parametro_Equipe',
-            'limite_maximo': 'Limite_Equipe'
-        }, inplace=True)
-
-        def get_status(row) -> str:
-            if row['Nº de Pessoas Vinculadas'] > row['Limite_Equipe']: return '🚨 ACIMA DO LIMITE MÁXIMO'
-            if row['Nº de Pessoas Vinculadas'] > row['Parametro_Equipe']: return '⚠️ Acima do Parâmetro'
-            return '✅ Dentro do Parâmetro'
-        
-        vinculos_df['Status'] = vinculos_df.apply(get_status, axis=1)
+        digests = [self._hash_upload(f) for f in files]
+        # Só os digests dos arquivos ainda enviados: os removidos do uploader saem da sessão
+        st.session_state["digests_upload"] = {f.file_id: d for f, d in zip(files, digests)}
+        self.fingerprint_dados = hash_conteudo('|'.join(digests).encode())
+
+        # A sessão guarda só a referência; sessões com os mesmos uploads compartilham os mesmos frames
+        with etapa("processar_uploads") as registro:
+            referencia = st.session_state.get("dados_upload")
+            lidos = []
+            def ler() -> DadosUpload:
+                lidos.append(True)
+                return self._ler_uploads(digests, files)
+            if referencia is None or referencia.chave != self.fingerprint_dados:
+                referencia = ARMAZEM_DADOS.obter(self.fingerprint_dados, ler)
+                st.session_state["dados_upload"] = referencia
+            dados: DadosUpload = referencia.valor
+            registro.linhas_saida = contar_linhas((dados.cid, dados.dom, dados.prod))
+            registro.cache = 'falta' if lidos else 'acerto'
+        for erro in dados.erros: st.error(erro)
+        self.df_cid_bruto, self.df_dom_bruto, self.df_prod_bruto = dados.cid, dados.dom, dados.prod
+        if dados.cubo_cid is not None: self.cubo_cid, self.cid_unicos_por_unidade, self.total_cid_unicos = dados.cubo_cid
+
+    def _calcular_vinculos(self) -> Optional[pd.DataFrame]:
+        if self.cubo_cid_filtrado is None: return None
+        return calcular_vinculos(self.cubo_cid_filtrado, self.parametros_municipio_atual)
+
+    def _materializar(self, nome: str, filtros: Tuple) -> Any:
+        """
+        Calcula um nó do grafo de dados derivados para uma combinação de uploads
+        (fingerprint) e dos filtros de que o nó depende. Em CACHE_DERIVADOS os
+        objetos são compartilhados sem cópia e não devem ser alterados pelas abas.
+        """
+        calculado = []
+        def calcular() -> Any:
+            calculado.append(True)
+            metodo, _, dependencias = self.GRAFO_DERIVADOS[nome]
+            for dependencia in dependencias: self._obter(dependencia)
+            return getattr(self, metodo)()
+        with etapa(f"derivado.{nome}") as registro:
+            valor = CACHE_DERIVADOS.obter((self.fingerprint_dados, nome, repr(filtros)), calcular)
+            registro.linhas_saida = contar_linhas(valor)
+            registro.cache = 'falta' if calculado else 'acerto'
+        return valor
+
+    def _obter(self, nome: str) -> Any:
+        """Materializa um dado derivado na primeira vez que é pedido nesta execução."""
+        if nome not in self._materializados:
+            setattr(self, nome, self._materializar(nome, self._filtros_do_no(nome)))
+            self._materializados.add(nome)
+        return getattr(self, nome)
+
+    def _filtros_do_no(self, nome: str) -> Tuple:
+        """Valores atuais dos filtros que entram na chave de cache de um nó do grafo."""
+        filtros = {'unidade': self.unidade_selecionada, 'periodo': self.periodo_selecionado, 'parametros': self.parametros_municipio_atual}
+        return tuple(filtros[f] for f in self.GRAFO_DERIVADOS[nome][1])
+
+    def _preparar_dados_para_analise(self, necessarios: List[str]):
+        """Materializa só os dados derivados de que a aba ativa precisa."""
+        self._materializados = set()
+        self.grupo_principal = COL_UNIDADE if self.unidade_selecionada == 'Todas' else 'Equipe'
+        with etapa("preparar_dados_para_analise"):
+            for nome in necessarios: self._obter(nome)
+
+    def _filtrar_cubo_cidadaos(self) -> Optional[pd.DataFrame]:
+        if self.cubo_cid is None: return None
+        return filtrar_cubo_cidadaos(self.cubo_cid, self.unidade_selecionada)
+
+    def _contar_cidadaos_filtrados(self) -> int:
+        if self.cubo_cid is None: return 0
+        if self.unidade_selecionada == 'Todas': return self.total_cid_unicos
+        return int(self.cid_unicos_por_unidade.get(self.unidade_selecionada, 0))
+
+    def _filtrar_domicilios(self) -> Optional[pd.DataFrame]:
+        return self.df_dom_bruto
+
+    def _filtrar_producao(self) -> Optional[pd.DataFrame]:
+        if self.df_prod_bruto is None: return None
+        if self.periodo_selecionado and len(self.periodo_selecionado) == 2:
+            return fatiar_periodo(self.df_prod_bruto, *self.periodo_selecionado)
+        return self.df_prod_bruto
+
+    def _montar_cubo_producao(self) -> Optional[pd.DataFrame]:
+        return None if self.df_prod_filtrado is None else montar_cubo_producao(self.df_prod_filtrado)
+
+    def _montar_matriz_tipos(self) -> Optional[pd.DataFrame]:
+        return None if self.df_prod_filtrado is None else montar_matriz_tipos(self.df_prod_filtrado)
+
+    def _tabela_cubo_cidadaos(self, col_categorica: str) -> pd.DataFrame:
+        """Contagem grupo × categoria do cubo filtrado: por unidade, ou por equipe com uma unidade selecionada."""
+        por_equipe = self.unidade_selecionada != 'Todas' and self.df_vinculos is not None
+        with etapa(f"crosstab.{col_categorica}", len(self.cubo_cid_filtrado)) as registro:
+            tab = tabela_cubo_cidadaos(self.cubo_cid_filtrado, col_categorica, self.df_vinculos if por_equipe else None)
+            registro.linhas_saida = len(tab)
+        return tab
 
-        def formatar_nome_exibicao(row):
-            tipo_sigla = f"EAP {row['Tipo de Equipe']}" if str(row['Tipo de Equipe']) in ['20', '30'] else 'ESF'
-            return f"{tipo_sigla} - {row['Unidade de Saúde']} - {row['INE']}"
-        
-        vinculos_df['Equipe'] = vinculos_df.apply(formatar_nome_exibicao, axis=1)
-
-        return vinculos_df.sort_values('Nº de Pessoas Vinculadas', ascending=False)
-
-    def _preparar_dados_para_analise(self):
-        if self.df_cid_bruto is not None:
-            self.df_cid_filtrado = self.df_cid_bruto if self.unidade_selecionada == 'Todas' else self.df_cid_bruto.query(f"`{COL_UNIDADE}` == @self.unidade_selecionada")
-            self.grupo_principal = COL_UNIDADE if self.unidade_selecionada == 'Todas' else 'Equipe'
-            self.df_vinculos = self._calcular_vinculos()
-        if self.df_dom_bruto is not None: self.df_dom_filtrado = self.df_dom_bruto.copy()
-        if self.df_prod_bruto is not None:
-            if self.periodo_selecionado and len(self.periodo_selecionado) == 2:
-                df_temp = self.df_prod_bruto.dropna(subset=['DATA'])
-                mask = (df_temp['DATA'].dt.date >= self.periodo_selecionado[0]) & (df_temp['DATA'].dt.date <= self.periodo_selecionado[1])
-                self.df_prod_filtrado = df_temp[mask]
-            else: self.df_prod_filtrado = self.df_prod_bruto.copy()
-            
     def _gerar_grafico_barras_crosstab(self, df: pd.DataFrame, grupo: str, col_categorica: str, ordem: List[str]):
         if grupo not in df.columns:
             st.warning(f"A coluna de agrupamento '{grupo}' não foi encontrada para o gráfico.")
             return None, None
-        tab = pd.crosstab(index=df[grupo], columns=df[col_categorica])
-        for cat in ordem:
-            if cat not in tab.columns: tab[cat] = 0
-        tab = tab[ordem]
-        tab['Total'] = tab.sum(axis=1)
-        tab = tab.sort_values('Total', ascending=False)
+        with etapa(f"crosstab.{col_categorica}", len(df)) as registro:
+            tab = crosstab_observado(df[grupo], df[col_categorica])
+            registro.linhas_saida = len(tab)
+        return self._gerar_grafico_barras(tab, col_categorica, ordem)
+
+    def _gerar_grafico_barras(self, tab: pd.DataFrame, col_categorica: str, ordem: List[str]):
+        """Barras horizontais empilhadas (%) de uma tabela de contagens grupo × categoria."""
+        grupo = tab.index.name
+        tab = tabela_categorias(tab, ordem)
         perc_df = tab.drop(columns='Total').div(tab['Total'], axis=0).fillna(0) * 100
-        melted_df = perc_df.reset_index().melt(id_vars=grupo, var_name=col_categorica, value_name='Percentual')
-        fig = px.bar(melted_df, y=grupo, x='Percentual', color=col_categorica, orientation='h', text=melted_df['Percentual'].map(lambda x: f"{x:.1f}%"), category_orders={col_categorica: ordem})
-        fig.update_layout(height=max(400, len(perc_df) * 45), yaxis={'categoryorder': 'total ascending'}, legend_title_text=col_categorica, xaxis_title="Percentual (%)")
+        with etapa("grafico.barras", len(perc_df)):
+            melted_df = perc_df.reset_index().melt(id_vars=grupo, var_name=col_categorica, value_name='Percentual')
+            fig = px.bar(melted_df, y=grupo, x='Percentual', color=col_categorica, orientation='h', text=melted_df['Percentual'].map(lambda x: f"{x:.1f}%"), category_orders={col_categorica: ordem})
+            fig.update_layout(height=max(400, len(perc_df) * 45), yaxis={'categoryorder': 'total ascending'}, legend_title_text=col_categorica, xaxis_title="Percentual (%)")
         return fig, tab
 
     def render_controls(self):
@@ -387,9 +458,11 @@ class DashboardAPS:
             if st.button("Sair / Logout", use_container_width=True, type="primary"):
                 st.session_state.logged_in = False
                 st.session_state.view = "menu"
+                self._liberar_uploads()
                 st.rerun()
 
             if not files:
+                self._liberar_uploads()
                 st.info("Aguardando o envio de arquivos para iniciar a análise.")
                 return
 
@@ -401,27 +474,14 @@ class DashboardAPS:
 
             # 🔹 Identificação automática do município pelo nome do arquivo
             municipios = sorted(self.df_parametros['MUNICIPIO'].unique())
-            map_norm = {_normalize_text(m): m for m in municipios}
-
-            municipio_inferido = None
-            for f in files:
-                nome_arquivo = _normalize_text(os.path.basename(f.name))
-                for key, original in map_norm.items():
-                    if key in nome_arquivo:   # procura o nome completo dentro do nome do arquivo
-                        municipio_inferido = original
-                        break
-                if municipio_inferido:
-                    break
-
-            self.municipio_selecionado = municipio_inferido or municipios[0]
+            self.municipio_selecionado = inferir_municipio([f.name for f in files], municipios) or municipios[0]
 
             # Guarda nos parâmetros da sessão (URL-friendly)
             st.query_params["municipio"] = self.municipio_selecionado
 
             # Carrega parâmetros do município escolhido
-            pars = self.df_parametros.query("MUNICIPIO == @self.municipio_selecionado").iloc[0]
-            self.parametros_municipio_atual = pars.to_dict()
-            self.parametro_oficial, self.limite_oficial = pars['PARAMETRO_ESF'], pars['LIMITE_ESF']
+            self.parametros_municipio_atual = parametros_do_municipio(self.df_parametros, self.municipio_selecionado)
+            self.parametro_oficial, self.limite_oficial = self.parametros_municipio_atual['PARAMETRO_ESF'], self.parametros_municipio_atual['LIMITE_ESF']
 
             # Exibe município detectado
             st.markdown(f"**Município detectado automaticamente:** `{self.municipio_selecionado}`")
@@ -436,9 +496,9 @@ class DashboardAPS:
 
             with filter_col2:
                 if self.df_prod_bruto is not None and 'DATA' in self.df_prod_bruto.columns:
-                    df_data = self.df_prod_bruto.dropna(subset=['DATA'])
-                    if not df_data.empty:
-                        min_date, max_date = df_data['DATA'].min().date(), df_data['DATA'].max().date()
+                    intervalo = intervalo_datas(self.df_prod_bruto)
+                    if intervalo:
+                        min_date, max_date = intervalo
                         self.periodo_selecionado = st.date_input("3. Filtrar Período (Produção)", (min_date, max_date))
 
     def _render_aba_resumo(self):
@@ -448,7 +508,7 @@ class DashboardAPS:
             return
 
         st.markdown("##### 📊 Visão Geral")
-        total_cidadaos = self.df_cid_filtrado[COL_CIDADAO].nunique()
+        total_cidadaos = self.total_cid_filtrado
         total_equipes = self.df_vinculos['Equipe Original'].nunique()
         acima_limite = self.df_vinculos[self.df_vinculos['Status'] == '🚨 ACIMA DO LIMITE MÁXIMO'].shape[0]
 
@@ -463,16 +523,17 @@ class DashboardAPS:
         col1, col2 = st.columns(2)
         with col1:
             st.markdown("**Situação do CPF**")
-            cpf_counts = self.df_cid_filtrado[COL_STATUS_DOC].value_counts()
+            cpf_counts = self.cubo_cid_filtrado.groupby(level=COL_STATUS_DOC, observed=False)['linhas'].sum().sort_values(ascending=False)
+            cpf_counts = cpf_counts[cpf_counts > 0]
             fig_cpf = px.pie(cpf_counts, values=cpf_counts.values, names=cpf_counts.index, hole=0.4, title="Cidadãos com e sem CPF")
             fig_cpf.update_traces(textinfo='percent+label', pull=[0.05, 0])
-            st.plotly_chart(fig_cpf, use_container_width=True)
+            exibir_grafico(fig_cpf)
         with col2:
             st.markdown("**Atualização Cadastral**")
-            tempo_counts = self.df_cid_filtrado[COL_TEMPO_SEM_ATUALIZAR].value_counts().reindex(CONFIG_VISUAL['ordem_tempo'])
+            tempo_counts = self.cubo_cid_filtrado.groupby(level=COL_TEMPO_SEM_ATUALIZAR, observed=False)['linhas'].sum().reindex(CONFIG_VISUAL['ordem_tempo'])
             fig_tempo = px.bar(tempo_counts, x=tempo_counts.index, y=tempo_counts.values, text_auto=True, title="Distribuição por Tempo de Atualização")
             fig_tempo.update_layout(yaxis_title="Nº de Cidadãos", xaxis_title="Tempo Sem Atualizar")
-            st.plotly_chart(fig_tempo, use_container_width=True)
+            exibir_grafico(fig_tempo)
         st.divider()
 
         st.markdown("##### 🎯 Pontos de Atenção")
@@ -485,11 +546,12 @@ class DashboardAPS:
                 orientation='h', title="Top 10 Equipes com Mais Pessoas Vinculadas"
             )
             fig.add_vline(self.limite_oficial, line_dash="dash", annotation_text="Limite ESF", line_color="red")
-            st.plotly_chart(fig, use_container_width=True)
+            exibir_grafico(fig)
 
         with tab2:
-            cadastros_desatualizados = self.df_cid_filtrado[self.df_cid_filtrado[COL_TEMPO_SEM_ATUALIZAR].isin(['13 A 24 MESES', 'MAIS DE 2 ANOS'])]
-            contagem_desatualizados = cadastros_desatualizados.groupby(COL_EQUIPE_COMPLETA).size().reset_index(name='Nº Desatualizados')
+            cubo = self.cubo_cid_filtrado['linhas']
+            cadastros_desatualizados = cubo[cubo.index.get_level_values(COL_TEMPO_SEM_ATUALIZAR).isin(['13 A 24 MESES', 'MAIS DE 2 ANOS'])]
+            contagem_desatualizados = cadastros_desatualizados.groupby(level=COL_EQUIPE_COMPLETA, observed=True).sum().reset_index(name='Nº Desatualizados').astype({COL_EQUIPE_COMPLETA: object})
             
             df_merged = pd.merge(self.df_vinculos, contagem_desatualizados, left_on='Equipe Original', right_on=COL_EQUIPE_COMPLETA, how='left').fillna(0)
             df_merged['% Desatualizados'] = (df_merged['Nº Desatualizados'] / df_merged['Nº de Pessoas Vinculadas']) * 100
@@ -501,17 +563,12 @@ class DashboardAPS:
                 x='% Desatualizados', y='Equipe', text=top_desatualizados['% Desatualizados'].map('{:.1f}%'.format),
                 orientation='h', title="Top 10 Equipes com Maior % de Cadastros Desatualizados (> 1 ano)"
             )
-            st.plotly_chart(fig, use_container_width=True)
+            exibir_grafico(fig)
         st.divider()
             
         if self.unidade_selecionada == 'Todas':
             st.markdown("##### 🏥 Resumo por Unidade de Saúde")
-            resumo_unidades = self.df_vinculos.groupby('Unidade de Saúde').agg(
-                N_Equipes=('Equipe Original', 'nunique'),
-                N_Cidadaos=('Nº de Pessoas Vinculadas', 'sum')
-            ).reset_index()
-            resumo_unidades['Media_Cidadaos_Equipe'] = resumo_unidades['N_Cidadaos'] / resumo_unidades['N_Equipes']
-            st.dataframe(resumo_unidades.sort_values("N_Cidadaos", ascending=False), use_container_width=True)
+            st.dataframe(resumo_unidades(self.df_vinculos), use_container_width=True)
         st.divider()
 
         if self.df_prod_filtrado is not None and not self.df_prod_filtrado.empty:
@@ -526,18 +583,16 @@ class DashboardAPS:
             
             if 'TIPO DE ATENDIMENTO' in self.df_prod_filtrado.columns:
                 atend_counts = self.df_prod_filtrado['TIPO DE ATENDIMENTO'].value_counts()
+                atend_counts = atend_counts[atend_counts > 0]
                 fig_atend = px.pie(atend_counts, values=atend_counts.values, names=atend_counts.index, title="Distribuição por Tipo de Atendimento")
-                st.plotly_chart(fig_atend, use_container_width=True)
+                exibir_grafico(fig_atend)
 
     def _render_aba_vinculo(self):
         st.header("Análise de Vínculos por Equipe")
         if self.df_vinculos is None: return
         
-        df_vinculos_enriquecido = self.df_vinculos.copy()
-        
-        df_vinculos_enriquecido['Excedente'] = (df_vinculos_enriquecido['Nº de Pessoas Vinculadas'] - df_vinculos_enriquecido['Limite_Equipe']).clip(lower=0)
-        df_vinculos_enriquecido['% Acima do Limite'] = ((df_vinculos_enriquecido['Excedente'] / df_vinculos_enriquecido['Limite_Equipe']) * 100).apply(lambda x: f"{x:.1f}%" if x > 0 else "N/A")
-        
+        df_vinculos_enriquecido = enriquecer_vinculos(self.df_vinculos)
+
         fig = px.bar(
             df_vinculos_enriquecido.sort_values('Nº de Pessoas Vinculadas'),
             x='Nº de Pessoas Vinculadas', y='Equipe',
@@ -553,7 +608,7 @@ class DashboardAPS:
                           xaxis_title="Nº de Pessoas Vinculadas", legend_title="Status", 
                           legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1))
         fig.update_traces(textposition='auto')
-        st.plotly_chart(fig, use_container_width=True)
+        exibir_grafico(fig)
         
         st.markdown("##### Tabela de Dados Detalhada")
         cols_to_show = ['Equipe', 'Nº de Pessoas Vinculadas', 'Tipo de Equipe', 'Status', 'Excedente', '% Acima do Limite', 'Unidade de Saúde']
@@ -562,45 +617,34 @@ class DashboardAPS:
 
     def _render_aba_tempo_cid(self):
         st.header("Análise de Tempo de Atualização (Cidadãos)")
-        if self.df_cid_filtrado is None: return
-        df_para_crosstab = self.df_cid_filtrado.copy()
-        grupo = COL_UNIDADE
-        if self.unidade_selecionada != 'Todas' and self.df_vinculos is not None:
-            mapa_nomes = pd.Series(self.df_vinculos['Equipe'].values, index=self.df_vinculos['Equipe Original']).to_dict()
-            df_para_crosstab['Equipe'] = df_para_crosstab[COL_EQUIPE_COMPLETA].map(mapa_nomes)
-            grupo = 'Equipe'
-
-        fig, tab = self._gerar_grafico_barras_crosstab(df_para_crosstab, grupo, COL_TEMPO_SEM_ATUALIZAR, CONFIG_VISUAL['ordem_tempo'])
+        if self.cubo_cid_filtrado is None: return
+        fig, tab = self._gerar_grafico_barras(self._tabela_cubo_cidadaos(COL_TEMPO_SEM_ATUALIZAR), COL_TEMPO_SEM_ATUALIZAR, CONFIG_VISUAL['ordem_tempo'])
         if fig and tab is not None:
-            st.plotly_chart(fig, use_container_width=True)
+            exibir_grafico(fig)
             st.dataframe(tab, use_container_width=True)
             exportar_excel(tab.reset_index(), f"tempo_atualizacao_cid_{self.municipio_selecionado}.xlsx")
 
     def _render_aba_cpf(self):
         st.header("Cadastros com/sem CPF")
-        if self.df_cid_filtrado is None: return
-        df_para_crosstab = self.df_cid_filtrado.copy()
-        grupo = COL_UNIDADE
-        if self.unidade_selecionada != 'Todas' and self.df_vinculos is not None:
-            mapa_nomes = pd.Series(self.df_vinculos['Equipe'].values, index=self.df_vinculos['Equipe Original']).to_dict()
-            df_para_crosstab['Equipe'] = df_para_crosstab[COL_EQUIPE_COMPLETA].map(mapa_nomes)
-            grupo = 'Equipe'
-
-        fig, tab = self._gerar_grafico_barras_crosstab(df_para_crosstab, grupo, COL_STATUS_DOC, CONFIG_VISUAL['ordem_cpf'])
+        if self.cubo_cid_filtrado is None: return
+        fig, tab = self._gerar_grafico_barras(self._tabela_cubo_cidadaos(COL_STATUS_DOC), COL_STATUS_DOC, CONFIG_VISUAL['ordem_cpf'])
         if fig and tab is not None:
-            st.plotly_chart(fig, use_container_width=True)
+            exibir_grafico(fig)
             st.dataframe(tab, use_container_width=True)
             exportar_excel(tab.reset_index(), f"cadastros_cpf_{self.municipio_selecionado}.xlsx")
 
+    # Fragmento: o filtro de família vinculada reexecuta só esta aba, sem refazer a leitura dos uploads
+    @st.fragment
+    @fragmento_medido
     def _render_aba_domicilios(self):
         st.header("Análise de Tempo de Atualização (🏠 Domicílios)")
         if self.df_dom_filtrado is None: return
         col_filtro = st.selectbox("Filtrar por família vinculada?", ["Todos", "Sim", "Não"])
-        df = self.df_dom_filtrado[self.df_dom_filtrado[COL_FAMILIA_VINCULADA].str.upper() == col_filtro.upper()] if col_filtro != "Todos" else self.df_dom_filtrado.copy()
+        df = self.df_dom_filtrado[self.df_dom_filtrado[COL_FAMILIA_VINCULADA].str.upper() == col_filtro.upper()] if col_filtro != "Todos" else self.df_dom_filtrado
         grupo_dom = 'ESTABELECIMENTO_COMPLETO'
         fig, tab = self._gerar_grafico_barras_crosstab(df, grupo_dom, COL_TEMPO_SEM_ATUALIZAR, CONFIG_VISUAL['ordem_tempo'])
         if fig and tab is not None:
-            st.plotly_chart(fig, use_container_width=True)
+            exibir_grafico(fig)
             st.dataframe(tab, use_container_width=True)
             exportar_excel(tab.reset_index(), f"tempo_atualizacao_dom_{self.municipio_selecionado}.xlsx")
 
@@ -610,10 +654,13 @@ class DashboardAPS:
         grupo_dom, ordem = 'ESTABELECIMENTO_COMPLETO', list(self.df_dom_filtrado[COL_FAMILIA_VINCULADA].dropna().unique())
         fig, tab = self._gerar_grafico_barras_crosstab(self.df_dom_filtrado, grupo_dom, COL_FAMILIA_VINCULADA, ordem)
         if fig and tab is not None:
-            st.plotly_chart(fig, use_container_width=True)
+            exibir_grafico(fig)
             st.dataframe(tab, use_container_width=True)
             exportar_excel(tab.reset_index(), f"familia_vinculada_{self.municipio_selecionado}.xlsx")
     
+    # Fragmento: os filtros de unidade/equipe/cargo reexecutam só esta aba, sem refazer a leitura dos uploads
+    @st.fragment
+    @fragmento_medido
     def _render_aba_producao_consolidada(self):
         st.header("Análise de Produção Consolidada")
         if self.df_prod_filtrado is None or self.df_prod_filtrado.empty:
@@ -622,30 +669,36 @@ class DashboardAPS:
         if 'TOTAL GERAL' not in self.df_prod_filtrado.columns:
             st.error("A planilha de produtividade precisa ter uma coluna 'TOTAL GERAL'.")
             return
+        if self.cubo_prod is None:
+            st.error(f"A planilha de produtividade precisa ter as colunas {', '.join(COLUNAS_CUBO_PRODUCAO)}.")
+            return
         
         st.markdown("##### Filtros da Análise")
-        df = self.df_prod_filtrado.copy()
+        cubo = self.cubo_prod
+        niveis = lambda c: cubo.index.get_level_values(c)
         c1, c2, c3 = st.columns(3)
-        unidade = c1.selectbox("Unidade de Saúde", ["Todas"] + sorted(df["ESTABELECIMENTO"].dropna().unique()), key="prod_unidade")
-        equipe = c2.selectbox("Equipe", ["Todas"] + sorted(df["EQUIPE"].dropna().unique()), key="prod_equipe")
-        cargo = c3.selectbox("Cargo (CBO)", ["Todas"] + sorted(df["DESCRIÇÃO DO CBO"].dropna().unique()), key="prod_cbo")
-        df_filt = df.copy()
-        if unidade != "Todas": df_filt = df_filt[df_filt["ESTABELECIMENTO"] == unidade]
-        if equipe != "Todas": df_filt = df_filt[df_filt["EQUIPE"] == equipe]
-        if cargo != "Todas": df_filt = df_filt[df_filt["DESCRIÇÃO DO CBO"] == cargo]
+        unidade = c1.selectbox("Unidade de Saúde", ["Todas"] + sorted(niveis("ESTABELECIMENTO").dropna().unique()), key="prod_unidade")
+        equipe = c2.selectbox("Equipe", ["Todas"] + sorted(niveis("EQUIPE").dropna().unique()), key="prod_equipe")
+        cargo = c3.selectbox("Cargo (CBO)", ["Todas"] + sorted(niveis("DESCRIÇÃO DO CBO").dropna().unique()), key="prod_cbo")
+        filtro = np.ones(len(cubo), dtype=bool)
+        if unidade != "Todas": filtro &= niveis("ESTABELECIMENTO") == unidade
+        if equipe != "Todas": filtro &= niveis("EQUIPE") == equipe
+        if cargo != "Todas": filtro &= niveis("DESCRIÇÃO DO CBO") == cargo
+        cubo_filt = cubo[filtro]
+        producao = cubo_filt['TOTAL GERAL']
         st.markdown("---")
         
         tab_geral, tab_detalhes = st.tabs(["📊 Visão Geral e Rankings", "🏢 Análise Detalhada por Unidade"])
         with tab_geral:
-            if df_filt.empty: 
+            if cubo_filt.empty: 
                 st.warning("Nenhum dado encontrado para os filtros selecionados.")
                 return
             
-            total_atendimentos = df_filt['TOTAL GERAL'].sum()
-            profissionais_unicos = df_filt['PROFISSIONAL'].nunique()
+            total_atendimentos = producao.sum()
+            profissionais_unicos = producao.index.get_level_values('PROFISSIONAL').nunique()
             media_por_profissional = total_atendimentos / profissionais_unicos if profissionais_unicos > 0 else 0
-            top_profissional_series = df_filt.groupby('PROFISSIONAL')['TOTAL GERAL'].sum().nlargest(1)
-            top_cargo_series = df_filt.groupby('DESCRIÇÃO DO CBO')['TOTAL GERAL'].sum().nlargest(1)
+            top_profissional_series = producao.groupby(level='PROFISSIONAL').sum().nlargest(1)
+            top_cargo_series = producao.groupby(level='DESCRIÇÃO DO CBO', observed=True).sum().nlargest(1)
             
             st.markdown("##### KPIs de Produtividade")
             kpi1, kpi2, kpi3, kpi4 = st.columns(4)
@@ -658,106 +711,120 @@ class DashboardAPS:
             
             st.markdown("<br>", unsafe_allow_html=True)
             st.markdown("##### Distribuição Hierárquica da Produção")
-            df_filt['PROFISSIONAL'] = df_filt['PROFISSIONAL'].fillna('Não Informado')
-            fig = px.treemap(df_filt, path=[px.Constant("Total"), 'ESTABELECIMENTO', 'EQUIPE', 'DESCRIÇÃO DO CBO', 'PROFISSIONAL'], values='TOTAL GERAL', color_continuous_scale='Blues', color='TOTAL GERAL', hover_data={'TOTAL GERAL':':.0f'})
+            caminho_treemap = ['ESTABELECIMENTO', 'EQUIPE', 'DESCRIÇÃO DO CBO', 'PROFISSIONAL']
+            df_treemap = cubo_filt.groupby(level=caminho_treemap, observed=True, dropna=False).sum().reset_index()
+            df_treemap = df_treemap.astype({c: object for c in caminho_treemap}).fillna({'PROFISSIONAL': 'Não Informado'})
+            # A cor de cada nó é a média de 'TOTAL GERAL' ponderada por ele mesmo (Σx²/Σx), como nas linhas brutas
+            df_treemap['COR'] = df_treemap['QUADRADOS'] / df_treemap['TOTAL GERAL']
+            fig = px.treemap(df_treemap, path=[px.Constant("Total")] + caminho_treemap, values='TOTAL GERAL', color_continuous_scale='Blues', color='COR', labels={'COR': 'TOTAL GERAL'}, hover_data={'TOTAL GERAL':':.0f'})
             fig.update_traces(hovertemplate='<b>%{label}</b><br>Produção: %{value}<br>Pai: %{parent}<extra></extra>')
             fig.update_layout(margin = dict(t=30, l=10, r=10, b=10))
-            st.plotly_chart(fig, use_container_width=True)
+            exibir_grafico(fig)
+
+            # Daqui em diante (rankings e detalhamento) o profissional vazio entra como 'Não Informado'
+            niveis_producao = producao.index.to_frame(index=False).fillna({'PROFISSIONAL': 'Não Informado'})
+            producao = pd.Series(producao.to_numpy(), index=pd.MultiIndex.from_frame(niveis_producao), name='TOTAL GERAL')
             
             st.markdown("---")
             col_rank1, col_rank2 = st.columns(2)
             with col_rank1:
                 st.markdown("##### 🏆 Top 5 Profissionais Mais Produtivos")
-                top_5_profissionais = df_filt.groupby('PROFISSIONAL')['TOTAL GERAL'].sum().nlargest(5).reset_index()
+                top_5_profissionais = producao.groupby(level='PROFISSIONAL').sum().nlargest(5).reset_index()
                 st.dataframe(top_5_profissionais, use_container_width=True, hide_index=True)
                 exportar_excel(top_5_profissionais, "top_5_profissionais.xlsx")
             with col_rank2:
                 st.markdown("##### 🚀 Top 5 Equipes Mais Produtivas")
-                top_5_equipes = df_filt.groupby('EQUIPE')['TOTAL GERAL'].sum().nlargest(5).reset_index()
+                top_5_equipes = producao.groupby(level='EQUIPE', observed=True).sum().nlargest(5).reset_index()
                 st.dataframe(top_5_equipes, use_container_width=True, hide_index=True)
                 exportar_excel(top_5_equipes, "top_5_equipes.xlsx")
 
+            st.markdown("---")
+            st.markdown("##### 📄 Extrato da Produção Filtrada")
+            n_registros = int(cubo_filt['LINHAS'].sum())
+            st.caption(f"{n_registros:,} registros com os filtros atuais.".replace(",", "."))
+            exportar_streaming(lambda: self._extrato_producao(unidade, equipe, cargo), n_registros, f"extrato_producao_{self.municipio_selecionado}.xlsx")
+
         with tab_detalhes:
             st.info("Esta aba contém a visão detalhada de produção para uma análise granular.")
-            if df_filt.empty: 
+            if cubo_filt.empty: 
                 st.warning("Nenhum dado encontrado para os filtros selecionados.")
                 return
             
-            for unidade_nome, unidade_df in df_filt.groupby("ESTABELECIMENTO"):
-                total_unidade = unidade_df.loc[~unidade_df["DESCRIÇÃO DO CBO"].isin(["AGENTE COMUNITÁRIO DE SAÚDE", "TÉCNICO EM AGENTE COMUNITÁRIO DE SAÚDE"]), "TOTAL GERAL"].sum()
+            for unidade_nome, producao_unidade in producao.groupby(level="ESTABELECIMENTO", observed=True):
+                total_unidade = producao_unidade[~producao_unidade.index.get_level_values("DESCRIÇÃO DO CBO").isin(["AGENTE COMUNITÁRIO DE SAÚDE", "TÉCNICO EM AGENTE COMUNITÁRIO DE SAÚDE"])].sum()
                 st.markdown(f"""<div style="width:100%; display:flex; align-items:center; justify-content:space-between; margin-bottom:6px; margin-top:20px; padding: 10px; background-color: #262730; border-radius: 8px;"><div style="font-size:1.2rem; font-weight:bold; color:#fafafa; display:flex; align-items:center;"><span style="font-size:1.3rem; margin-right:10px;">🏥</span> {unidade_nome}</div><div style="font-size: 1.1rem; font-weight: bold; color:#f8f9fa; display: flex; align-items: center;">Total de produção na unidade:<span style="background: #212c23; color: #2ecc71; border-radius: 4px; padding:2px 12px; font-size: 1rem; font-weight: bold; margin-left: 10px;">{int(total_unidade) if pd.notnull(total_unidade) else "-"}</span></div></div>""", unsafe_allow_html=True)
                 with st.expander("Ver detalhes da produção desta unidade"):
-                    grafico_cbo_empilhado = unidade_df.groupby(["DESCRIÇÃO DO CBO", "EQUIPE"])["TOTAL GERAL"].sum().reset_index()
+                    grafico_cbo_empilhado = producao_unidade.groupby(level=["DESCRIÇÃO DO CBO", "EQUIPE"], observed=True).sum().reset_index().astype({"DESCRIÇÃO DO CBO": object, "EQUIPE": object})
                     ordem_cbo = grafico_cbo_empilhado.groupby("DESCRIÇÃO DO CBO")["TOTAL GERAL"].sum().sort_values(ascending=False).index.tolist()
                     fig_bar = px.bar(grafico_cbo_empilhado, y="DESCRIÇÃO DO CBO", x="TOTAL GERAL", color="EQUIPE", orientation="h", title="Produção por Cargo (Empilhado por Equipe)", text="TOTAL GERAL")
                     fig_bar.update_layout(barmode="stack", yaxis={'categoryorder':'array', 'categoryarray': ordem_cbo})
-                    st.plotly_chart(fig_bar, use_container_width=True)
-                    for equipe_nome, equipe_df in unidade_df.groupby("EQUIPE"):
+                    exibir_grafico(fig_bar)
+                    for equipe_nome, producao_equipe in producao_unidade.groupby(level="EQUIPE", observed=True):
                         st.subheader(f"Equipe: {equipe_nome}")
-                        ordem_cbo_equipe = equipe_df.groupby("DESCRIÇÃO DO CBO")["TOTAL GERAL"].sum().sort_values(ascending=False).index.tolist()
+                        ordem_cbo_equipe = producao_equipe.groupby(level="DESCRIÇÃO DO CBO", observed=True).sum().sort_values(ascending=False).index.tolist()
                         for cbo_nome in ordem_cbo_equipe:
                             st.markdown(f"**Cargo:** {cbo_nome}")
-                            cbo_df = equipe_df[equipe_df["DESCRIÇÃO DO CBO"] == cbo_nome]
-                            profs = cbo_df.groupby("PROFISSIONAL")["TOTAL GERAL"].sum().reset_index().sort_values("TOTAL GERAL", ascending=False)
+                            producao_cbo = producao_equipe[producao_equipe.index.get_level_values("DESCRIÇÃO DO CBO") == cbo_nome]
+                            profs = producao_cbo.groupby(level="PROFISSIONAL").sum().reset_index().sort_values("TOTAL GERAL", ascending=False)
                             st.dataframe(profs, use_container_width=True, hide_index=True)
 
+    def _extrato_producao(self, unidade: str, equipe: str, cargo: str) -> pd.DataFrame:
+        """Registros da produção do período com os filtros da aba de produção consolidada."""
+        df = self.df_prod_filtrado
+        filtro = np.ones(len(df), dtype=bool)
+        for col, valor in (("ESTABELECIMENTO", unidade), ("EQUIPE", equipe), ("DESCRIÇÃO DO CBO", cargo)):
+            if valor != "Todas": filtro &= (df[col] == valor).to_numpy()
+        return df[filtro]
+
     def _render_aba_tipo_atendimento_esf(self):
         st.header("Análise Estratégica de Tipos de Atendimento")
         if self.df_prod_filtrado is None or 'TIPO DE ATENDIMENTO' not in self.df_prod_filtrado.columns:
             st.info("Envie uma planilha de produtividade com a coluna 'TIPO DE ATENDIMENTO' e ajuste o filtro de data para visualizar esta seção.")
             return
+        if self.matriz_tipos_atendimento is None:
+            st.error("A planilha de produtividade precisa ter uma coluna 'ESTABELECIMENTO'.")
+            return
 
-        df = self.df_prod_filtrado.copy()
-        df.rename(columns={'ESTABELECIMENTO': 'Unidade de Saúde'}, inplace=True)
-        
-        mapa_categorias = {
-            'CONSULTA AGENDADA': 'Cuidado Programado',
-            'CONSULTA AGENDADA PROGRAMADA / CUIDADO CONTINUADO': 'Cuidado Programado',
-            'CONSULTA NO DIA': 'Demanda Espontânea',
-            'ATENDIMENTO DE URGÊNCIA': 'Demanda Espontânea',
-            'ESCUTA INICIAL / ORIENTAÇÃO': 'Outros'
-        }
-        df['Categoria Atendimento'] = df['TIPO DE ATENDIMENTO'].map(mapa_categorias)
+        # Todas as tabelas da aba saem de uma única matriz unidade × tipo de atendimento
+        matriz = self.matriz_tipos_atendimento
+        matriz_unidades = matriz.loc[matriz.index.notna()]
+        categoria_tipo = categorias_dos_tipos(matriz)
         
         st.markdown("##### 📊 Visão Geral: Programado vs. Demanda Espontânea")
-        total_atendimentos = len(df)
+        total_atendimentos = int(matriz.to_numpy().sum())
         
         kpi1, kpi2, kpi3 = st.columns(3)
         kpi1.metric("Total de Atendimentos", f"{total_atendimentos:,}".replace(",", "."))
         
         if total_atendimentos > 0:
-            categoria_counts = df['Categoria Atendimento'].value_counts()
+            totais_tipo = matriz.sum(axis=0)
+            categoria_counts = totais_tipo.groupby(categoria_tipo.values).sum()
             programado_perc = categoria_counts.get('Cuidado Programado', 0) / total_atendimentos
             demanda_perc = categoria_counts.get('Demanda Espontânea', 0) / total_atendimentos
             
             kpi2.metric("🗓️ % Cuidado Programado", f"{programado_perc:.1%}")
             kpi3.metric("🏃 % Demanda Espontânea", f"{demanda_perc:.1%}")
 
-            fig_treemap = px.treemap(df.dropna(subset=['Categoria Atendimento', 'TIPO DE ATENDIMENTO']),
+            df_treemap = pd.DataFrame({
+                'Categoria Atendimento': categoria_tipo.values, 'TIPO DE ATENDIMENTO': totais_tipo.index.astype(object), 'count': totais_tipo.values
+            }).dropna(subset=['Categoria Atendimento', 'TIPO DE ATENDIMENTO']).query('count > 0')
+            fig_treemap = px.treemap(df_treemap, values='count',
                                      path=[px.Constant("Todos Atendimentos"), 'Categoria Atendimento', 'TIPO DE ATENDIMENTO'],
                                      title="Composição dos Atendimentos Realizados no Período")
             fig_treemap.update_traces(root_color="lightgrey")
             fig_treemap.update_layout(margin = dict(t=50, l=25, r=25, b=25))
-            st.plotly_chart(fig_treemap, use_container_width=True)
+            exibir_grafico(fig_treemap)
         st.divider()
 
         st.markdown("##### 🏥 Análise Estratégica por Unidades de Saúde")
         tab1, tab2, tab3, tab4 = st.tabs(["⭐ Scorecard Gerencial", "📊 Perfil Comparativo", "🔥 Focos de Demanda Espontânea", "🗓️ Destaques em Cuidado Programado"])
 
-        crosstab_unidades = pd.crosstab(df['Unidade de Saúde'], df['Categoria Atendimento'])
-        crosstab_unidades.columns.name = None
-        crosstab_unidades = crosstab_unidades.reindex(columns=['Cuidado Programado', 'Demanda Espontânea', 'Outros'], fill_value=0)
+        crosstab_unidades = perfil_unidades(matriz)
 
         with tab1:
             st.markdown("**Classificação de performance das unidades baseada no perfil de atendimento.**")
-            scorecard = crosstab_unidades.copy()
-            scorecard['Total'] = scorecard.sum(axis=1)
-            scorecard['% Programado'] = (scorecard['Cuidado Programado'] / scorecard['Total']) * 100
-            scorecard['% Demanda'] = (scorecard['Demanda Espontânea'] / scorecard['Total']) * 100
-            scorecard['Índice Eficiência (Prog/Demanda)'] = scorecard['Cuidado Programado'] / scorecard['Demanda Espontânea']
+            scorecard_display = scorecard_unidades(crosstab_unidades)
 
-            scorecard_display = scorecard[['% Programado', '% Demanda', 'Índice Eficiência (Prog/Demanda)']].sort_values('Índice Eficiência (Prog/Demanda)', ascending=False).fillna(0)
-            
             st.dataframe(scorecard_display.style
                          .background_gradient(cmap='Greens', subset=['% Programado', 'Índice Eficiência (Prog/Demanda)'])
                          .background_gradient(cmap='Reds_r', subset=['% Demanda'])
@@ -774,7 +841,7 @@ class DashboardAPS:
                               title="Perfil de Atendimento por Unidade de Saúde (%)",
                               labels={'x': '', 'value': 'Percentual de Atendimentos (%)'},
                               text_auto='.1f', barmode='stack', height=max(400, len(tabela_perc)*25))
-            st.plotly_chart(fig_comp, use_container_width=True)
+            exibir_grafico(fig_comp)
             
             # Insights Automáticos
             best_unit_programado = tabela_perc.idxmax()['Cuidado Programado']
@@ -784,30 +851,27 @@ class DashboardAPS:
 
         with tab3:
             st.markdown("**Quais unidades estão sob maior pressão de atendimentos não planejados?**")
-            df_demanda = df[df['Categoria Atendimento'] == 'Demanda Espontânea']
-            tabela_demanda = pd.crosstab(df_demanda['Unidade de Saúde'], df_demanda['TIPO DE ATENDIMENTO'])
+            tabela_demanda = remover_vazios(matriz_unidades.loc[:, (categoria_tipo == 'Demanda Espontânea').values])
             tabela_demanda = tabela_demanda.sort_values(['ATENDIMENTO DE URGÊNCIA', 'CONSULTA NO DIA'], ascending=False).head(15)
             
             fig_demanda = px.bar(tabela_demanda, y=tabela_demanda.index, x=['ATENDIMENTO DE URGÊNCIA', 'CONSULTA NO DIA'],
                                 title="Top 15 Unidades por Volume de Demanda Espontânea", barmode='group', text_auto=True, orientation='h')
             fig_demanda.update_layout(yaxis={'categoryorder':'total ascending'}, height=max(400, len(tabela_demanda)*40))
-            st.plotly_chart(fig_demanda, use_container_width=True)
+            exibir_grafico(fig_demanda)
 
         with tab4:
             st.markdown("**Quais unidades se destacam no cuidado continuado e agendado?**")
-            df_programado = df[df['Categoria Atendimento'] == 'Cuidado Programado']
-            tabela_programado = pd.crosstab(df_programado['Unidade de Saúde'], df_programado['TIPO DE ATENDIMENTO'])
+            tabela_programado = remover_vazios(matriz_unidades.loc[:, (categoria_tipo == 'Cuidado Programado').values])
             tabela_programado['Total Programado'] = tabela_programado.sum(axis=1)
             tabela_programado = tabela_programado.sort_values('Total Programado', ascending=False).head(15)
             
             fig_programado = px.bar(tabela_programado.drop(columns='Total Programado'), y=tabela_programado.index, x=['CONSULTA AGENDADA', 'CONSULTA AGENDADA PROGRAMADA / CUIDADO CONTINUADO'],
                                     title="Top 15 Unidades por Volume de Cuidado Programado", barmode='stack', text_auto=True, orientation='h')
             fig_programado.update_layout(yaxis={'categoryorder':'total ascending'}, height=max(400, len(tabela_programado)*40))
-            st.plotly_chart(fig_programado, use_container_width=True)
+            exibir_grafico(fig_programado)
 
         with st.expander("Clique para ver a tabela detalhada de atendimentos"):
-            tabela_final = pd.crosstab(df['Unidade de Saúde'], df['TIPO DE ATENDIMENTO'])
-            tabela_final["Total Geral"] = tabela_final.sum(axis=1)
+            tabela_final = tabela_tipos_atendimento(matriz)
             st.dataframe(tabela_final.sort_values("Total Geral", ascending=False), use_container_width=True)
             exportar_excel(tabela_final.reset_index(), f"tipo_atendimento_{self.municipio_selecionado}.xlsx")
 
@@ -815,20 +879,101 @@ class DashboardAPS:
     def _render_aba_tipos_consultas_esb(self):
         st.header("Tipos de Consultas ESB")
         if self.df_prod_filtrado is None: st.info("Envie uma planilha de produtividade para esta análise."); return
-        col_tipo_consulta = next((c for c in self.df_prod_filtrado.columns if _normalize_text(c) == "TIPO DE CONSULTA"), None)
+        col_tipo_consulta = coluna_tipo_consulta(self.df_prod_filtrado)
         if not col_tipo_consulta: st.warning("Coluna 'TIPO DE CONSULTA' não encontrada na planilha."); return
-        df, categorias = self.df_prod_filtrado, ["Consulta de manutenção em odontologia", "Consulta de retorno em odontologia", "Não informado", "Primeira consulta odontológica programática "]
-        tabela = pd.pivot_table(df, values="PROFISSIONAL", index=["ESTABELECIMENTO"], columns=[col_tipo_consulta], aggfunc="count", fill_value=0)
-        for cat in categorias:
-            if cat not in tabela.columns: tabela[cat] = 0
-        tabela = tabela[categorias]
-        tabela["Total Unidade"] = tabela.sum(axis=1)
-        total_geral = tabela[categorias].sum().to_frame().T
-        total_geral.index, total_geral["Total Unidade"] = ["Total Geral"], total_geral.sum(axis=1)
-        tabela_final = pd.concat([tabela, total_geral])
+        tabela_final = tabela_consultas_esb(self.df_prod_filtrado, col_tipo_consulta)
         st.dataframe(tabela_final, use_container_width=True)
         exportar_excel(tabela_final.reset_index(), f"consultas_esb_{self.municipio_selecionado}.xlsx")
 
+    def _render_aba_memoria(self):
+        st.header("🧠 Memória do Processo")
+        if not DIAGNOSTICO_ATIVO:
+            st.error("Diagnóstico desativado (variável de ambiente APS_DIAGNOSTICO=1).")
+            return
+        mb = lambda n: round(n / 1024 ** 2, 1)
+        memoria = memoria_processo()
+        metricas = {nome: cache.metricas() for nome, cache in CACHES.items()}
+
+        kpi1, kpi2, kpi3 = st.columns(3)
+        kpi1.metric("Memória Residente (RSS)", f"{mb(memoria['rss']):,.0f} MB".replace(",", ".") if 'rss' in memoria else "-")
+        kpi2.metric("Pico do Processo", f"{mb(memoria['pico']):,.0f} MB".replace(",", ".") if 'pico' in memoria else "-")
+        kpi3.metric("Nos Caches do Painel", f"{mb(sum(m['bytes'] for m in metricas.values())):,.0f} MB".replace(",", "."))
+        historico = HISTORICO_MEMORIA.tabela()
+        if len(historico) > 1: st.line_chart(historico)
+        else: st.caption(f"A memória do processo é lida a cada {INTERVALO_MEMORIA} s; o gráfico aparece a partir da segunda leitura.")
+        st.divider()
+
+        # Brutos medidos agora (deep=True); derivados com o tamanho medido ao entrar no cache
+        st.markdown("##### 📂 Dados desta Sessão")
+        linhas = [
+            {'Dado': nome, 'Linhas': contar_linhas(valor), 'MB': mb(tamanho_bytes(valor)), 'Situação': 'carregado'}
+            for nome, valor in (('df_cid_bruto', self.df_cid_bruto), ('cubo_cid', self.cubo_cid), ('df_dom_bruto', self.df_dom_bruto), ('df_prod_bruto', self.df_prod_bruto))
+            if valor is not None
+        ]
+        derivados = {entrada['chave'][1:]: entrada for entrada in CACHE_DERIVADOS.entradas() if entrada['chave'][0] == self.fingerprint_dados}
+        for nome in self.GRAFO_DERIVADOS:
+            entrada = derivados.get((nome, repr(self._filtros_do_no(nome))))
+            linhas.append({'Dado': nome, 'Linhas': contar_linhas(entrada['valor']) if entrada else None, 'MB': mb(entrada['bytes']) if entrada else None, 'Situação': 'em cache' if entrada else 'não calculado'})
+        tabela_sessao = pd.DataFrame(linhas).astype({'Linhas': 'Int64'})
+        st.dataframe(tabela_sessao, use_container_width=True, hide_index=True)
+        st.caption("Os dados derivados são os dos filtros atuais; as outras combinações de filtros entram no total do cache 'derivados'.")
+
+        st.markdown("##### 🗂️ Uploads no Processo (todas as sessões)")
+        municipios = sorted(self.df_parametros['MUNICIPIO'].unique())
+        derivados_por_conjunto: Dict[str, int] = {}
+        for entrada in CACHE_DERIVADOS.entradas():
+            derivados_por_conjunto[entrada['chave'][0]] = derivados_por_conjunto.get(entrada['chave'][0], 0) + entrada['bytes']
+        conjuntos = [{
+            'Município': inferir_municipio(list(entrada['valor'].nomes), municipios) or '-',
+            'Arquivos': len(entrada['valor'].nomes),
+            'Linhas': contar_linhas((entrada['valor'].cid, entrada['valor'].dom, entrada['valor'].prod)),
+            'MB (uploads)': mb(entrada['bytes']),
+            'MB (derivados)': mb(derivados_por_conjunto.get(entrada['chave'], 0)),
+            'Sessões': entrada['sessoes'],
+            'Esta Sessão': entrada['chave'] == self.fingerprint_dados,
+        } for entrada in ARMAZEM_DADOS.entradas()]
+        if conjuntos: st.dataframe(pd.DataFrame(conjuntos).sort_values('MB (uploads)', ascending=False), use_container_width=True, hide_index=True)
+
+        st.markdown("##### 🧮 Caches")
+        caches = [{
+            'Cache': nome, 'Entradas': m['entradas'], 'MB': mb(m['bytes']), 'Limite (MB)': mb(m['limite_bytes']),
+            'Acertos': m['acertos'], 'Faltas': m['faltas'], 'Descartes': m['descartes'],
+        } for nome, m in metricas.items()]
+        # st.cache_data não expõe as entradas: a única função em cache é a dos parâmetros (max_entries=1)
+        caches.append({'Cache': 'st.cache_data: carregar_parametros', 'Entradas': 1, 'MB': mb(tamanho_bytes(self.df_parametros))})
+        st.dataframe(pd.DataFrame(caches).astype({c: 'Int64' for c in ('Acertos', 'Faltas', 'Descartes')}), use_container_width=True, hide_index=True)
+
+    def _render_aba_latencia(self):
+        st.header("⏱️ Latência das Execuções por Aba")
+        if not LATENCIAS_ATIVO:
+            st.error("Registro de latências desativado (variável de ambiente APS_LATENCIAS=1 ou APS_DIAGNOSTICO=1).")
+            return
+        c1, c2, c3 = st.columns(3)
+        dias = c1.selectbox("Período", [1, 7, 30, 90], index=1, format_func=lambda d: "Últimas 24 horas" if d == 1 else f"Últimos {d} dias", key="latencia_dias")
+        agrupamentos = {"Hora": pd.offsets.Hour(), "Dia": pd.offsets.Day(), "Semana": pd.offsets.Week(weekday=0)}
+        agrupamento = c2.selectbox("Agrupar por", list(agrupamentos), index=1, key="latencia_agrupamento")
+        percentil = c3.selectbox("Percentil do gráfico", list(PERCENTIS_LATENCIA), index=1, key="latencia_percentil")
+        execucoes = REGISTRO_LATENCIAS.carregar(desde=datetime.now() - timedelta(days=dias))
+        if execucoes.empty:
+            st.info("Nenhuma execução registrada no período.")
+            return
+
+        # Todas as abas do painel aparecem, inclusive as que ninguém abriu no período
+        st.markdown("##### Percentis por Aba (ms)")
+        resumo = percentis_latencia(execucoes, ['view'])
+        resumo = resumo.reindex(list(dict.fromkeys(self.abas + list(resumo.index)))).fillna({'execucoes': 0})
+        resumo = resumo.astype({'execucoes': int}).sort_values('p95', ascending=False)
+        resumo[list(PERCENTIS_LATENCIA) + ['max']] = (resumo[list(PERCENTIS_LATENCIA) + ['max']] * 1000).round(0)
+        resumo['ultima'] = execucoes.groupby('view')['momento'].max()
+        resumo = resumo.rename(columns={'execucoes': 'Execuções', 'max': 'Máx', 'ultima': 'Última Execução'}).rename_axis('Aba')
+        st.dataframe(resumo, use_container_width=True)
+        st.caption("As linhas '<aba>.fragmento' são as reexecuções só dos filtros da aba (Domicílios e Produção Consolidada), sem a execução completa do painel.")
+
+        st.markdown(f"##### {percentil} por Aba ao Longo do Tempo (ms)")
+        por_periodo = percentis_latencia(execucoes, [pd.Grouper(key='momento', freq=agrupamentos[agrupamento]), 'view'])
+        st.line_chart((por_periodo[percentil] * 1000).unstack('view'))
+        st.caption(f"{len(execucoes):,} execuções registradas em `{REGISTRO_LATENCIAS.caminho}` (guardadas por {REGISTRO_LATENCIAS.validade_dias} dias).".replace(",", "."))
+
     def _render_menu_page(self):
         menu_style = """
         <style>
@@ -844,6 +989,8 @@ class DashboardAPS:
         if self.df_cid_bruto is not None: reports.extend([("⭐ Painel Resumo", "resumo"), ("📈 Vínculo", "vinculo"), ("⏳ Atualização", "tempo_cid"), ("📇 CPF", "cpf")])
         if self.df_dom_bruto is not None: reports.extend([("🏠 Domicílios", "domicilios"), ("🏘️ Família Vinculada", "familia_vinculada")])
         if self.df_prod_bruto is not None: reports.extend([("📊 Produção Consolidada", "producao"), ("📑 Tipo de Atendimento ESF", "tipo_atendimento"), ("🦷 Tipos de Consultas ESB", "consultas_esb")])
+        if DIAGNOSTICO_ATIVO: reports.append(("🧠 Memória do Processo", "memoria"))
+        if LATENCIAS_ATIVO: reports.append(("⏱️ Latência por Aba", "latencia"))
         if not reports: return
         cols = st.columns(3)
         for i, (label, view_name) in enumerate(reports):
@@ -857,19 +1004,77 @@ class DashboardAPS:
             st.session_state.view = "menu"
             st.rerun()
 
+        # Cada aba declara os dados derivados (nós de GRAFO_DERIVADOS) de que precisa
         view_map = {
-            "menu": self._render_menu_page,
-            "resumo": self._render_aba_resumo, "vinculo": self._render_aba_vinculo,
-            "tempo_cid": self._render_aba_tempo_cid, "cpf": self._render_aba_cpf,
-            "domicilios": self._render_aba_domicilios, "familia_vinculada": self._render_aba_familia_vinculada,
-            "producao": self._render_aba_producao_consolidada, "tipo_atendimento": self._render_aba_tipo_atendimento_esf,
-            "consultas_esb": self._render_aba_tipos_consultas_esb,
+            "menu": (self._render_menu_page, []),
+            "resumo": (self._render_aba_resumo, ['cubo_cid_filtrado', 'total_cid_filtrado', 'df_vinculos', 'df_prod_filtrado']),
+            "vinculo": (self._render_aba_vinculo, ['df_vinculos']),
+            "tempo_cid": (self._render_aba_tempo_cid, ['cubo_cid_filtrado', 'df_vinculos']),
+            "cpf": (self._render_aba_cpf, ['cubo_cid_filtrado', 'df_vinculos']),
+            "domicilios": (self._render_aba_domicilios, ['df_dom_filtrado']),
+            "familia_vinculada": (self._render_aba_familia_vinculada, ['df_dom_filtrado']),
+            "producao": (self._render_aba_producao_consolidada, ['df_prod_filtrado', 'cubo_prod']),
+            "tipo_atendimento": (self._render_aba_tipo_atendimento_esf, ['df_prod_filtrado', 'matriz_tipos_atendimento']),
+            "consultas_esb": (self._render_aba_tipos_consultas_esb, ['df_prod_filtrado']),
+            "memoria": (self._render_aba_memoria, []),
+            "latencia": (self._render_aba_latencia, []),
         }
-        render_function = view_map.get(view, lambda: st.error("Página não encontrada."))
-        render_function()
+        self.abas = list(view_map)
+        render_function, necessarios = view_map.get(view, (lambda: st.error("Página não encontrada."), []))
+        self._preparar_dados_para_analise(necessarios)
+        with etapa(f"aba.{view}"):
+            render_function()
+
+    def _render_diagnostico(self, rastreador: Rastreador):
+        """Tempos por etapa desta execução, também acrescentados ao registro JSONL."""
+        caminho = rastreador.gravar(
+            view=st.session_state.get("view"), municipio=self.municipio_selecionado, unidade=self.unidade_selecionada, periodo=self.periodo_selecionado
+        )
+        with st.expander("🩺 Diagnóstico de desempenho (esta execução)", expanded=False):
+            st.dataframe(rastreador.tabela(), use_container_width=True, hide_index=True)
+            if caminho: st.caption(f"Registrado em `{caminho}`.")
+            if st.button("⏺️ Perfilar a próxima execução", key="perfilar_proxima_btn"): st.session_state.perfilar_proxima = True
+            if st.session_state.get("perfilar_proxima"): st.caption("A próxima execução desta sessão (ex.: ao abrir uma aba ou mudar um filtro) será perfilada.")
+
+    def _registrar_latencia(self, segundos: float, view: Optional[str] = None):
+        REGISTRO_LATENCIAS.registrar(
+            segundos, view=view or st.session_state.get("view"), municipio=self.municipio_selecionado,
+            filtros={'unidade': self.unidade_selecionada, 'periodo': self.periodo_selecionado},
+            linhas={'cid': contar_linhas(self.df_cid_bruto), 'dom': contar_linhas(self.df_dom_bruto), 'prod': contar_linhas(self.df_prod_bruto)},
+        )
+
+    def _perfil_pedido(self) -> bool:
+        """Perfila esta execução: sempre com APS_PERFIL=1, ou a seguinte ao botão do painel de diagnóstico."""
+        return PERFIL_ATIVO or (DIAGNOSTICO_ATIVO and bool(st.session_state.get("perfilar_proxima")))
+
+    def _gravar_perfil(self, perfilador: Perfilador):
+        linhas = contar_linhas((self.df_cid_bruto, self.df_dom_bruto, self.df_prod_bruto)) or 0
+        caminhos = perfilador.gravar(
+            view=st.session_state.get("view"), municipio=self.municipio_selecionado or "sem_municipio", linhas=f"{linhas}linhas"
+        )
+        if caminhos: st.info("Perfil desta execução gravado em " + " e ".join(f"`{c}`" for c in caminhos) + ".")
 
     def run(self):
         """Método principal que executa o aplicativo."""
+        if DIAGNOSTICO_ATIVO: HISTORICO_MEMORIA.iniciar()
+        rastreador = Rastreador() if st.session_state.get("logged_in") and DIAGNOSTICO_ATIVO else None
+        perfilador = Perfilador() if self._perfil_pedido() else None
+        # Um st.rerun() no meio da execução interrompe o bloco e a execução não é registrada
+        inicio = time.perf_counter()
+        self._em_execucao = True
+        try:
+            with rastreador or nullcontext(), perfilador or nullcontext():
+                with etapa("execucao"): self._executar()
+        finally:
+            self._em_execucao = False
+        if LATENCIAS_ATIVO and st.session_state.get("logged_in"): self._registrar_latencia(time.perf_counter() - inicio)
+        if perfilador is not None:
+            # O pedido só é consumido por uma execução que terminou (com st.rerun() no meio, vale para a seguinte)
+            st.session_state.pop("perfilar_proxima", None)
+            self._gravar_perfil(perfilador)
+        if rastreador is not None: self._render_diagnostico(rastreador)
+
+    def _executar(self):
         if not st.session_state.get("logged_in"):
             self._render_login_page()
         else:
@@ -887,10 +1092,13 @@ class DashboardAPS:
                 or self.df_prod_bruto is not None
             )
             if has_data:
-                self._preparar_dados_para_analise()
                 self.render_dashboard_content()
             else:
                 st.info("⬆️ **Bem-vindo(a)!** Por favor, envie uma ou mais planilhas no painel de controles acima para iniciar a análise.")
+                # As páginas de diagnóstico não dependem das planilhas
+                if DIAGNOSTICO_ATIVO or LATENCIAS_ATIVO:
+                    if st.session_state.get("view") not in ("menu", "memoria", "latencia"): st.session_state.view = "menu"
+                    self.render_dashboard_content()
 
 if __name__ == "__main__":
     app = DashboardAPS()
@@ -0,0 +1,244 @@
+"""
+Armazém de dados do processo: conjuntos de dados imutáveis endereçados pelo hash
+do conteúdo e compartilhados por todas as sessões do servidor.
+
+`CacheMemoria` é um cache LRU limitado pelo tamanho real (em bytes) dos valores,
+com métricas de acertos, faltas, descartes e bytes ocupados. `ArmazemDados` é um
+CacheMemoria em que as sessões guardam uma `Referencia` (não o DataFrame):
+enquanto houver alguma referência viva o conjunto não é descartado; quando a
+última é coletada (a sessão troca de uploads ou termina), ele volta a concorrer
+ao descarte pelo uso menos recente.
+
+Os valores são compartilhados sem cópia e NÃO devem ser alterados (no painel o
+copy-on-write do pandas garante que filtros e atribuições gerem frames novos).
+
+`VooUnico` evita cálculos repetidos em paralelo: sessões que pedem ao mesmo tempo
+o mesmo cálculo (mesmo hash de conteúdo) esperam uma única execução em andamento.
+Este módulo não depende do Streamlit.
+"""
+
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+import pandas as pd
+
+# Orçamento de memória (MB) do armazém de uploads; os conjuntos em uso por alguma sessão nunca são descartados
+LIMITE_ARMAZEM_MB = int(os.environ.get('APS_ARMAZEM_MB', 2048))
+# Orçamentos (MB) dos caches de dados derivados (filtros, cubos) e dos arquivos de exportação
+LIMITE_DERIVADOS_MB = int(os.environ.get('APS_CACHE_DERIVADOS_MB', 1024))
+LIMITE_EXPORTACOES_MB = int(os.environ.get('APS_CACHE_EXPORTACOES_MB', 256))
+
+def tamanho_bytes(valor: Any) -> int:
+    """
+    Memória ocupada por um valor em cache: memory_usage(deep=True) para objetos do
+    pandas, somado sobre tuplas, listas e dicionários. Frames que compartilham
+    dados (fatias) são contados por inteiro, então é uma estimativa por cima.
+    """
+    if isinstance(valor, pd.DataFrame): return int(valor.memory_usage(index=True, deep=True).sum())
+    if isinstance(valor, (pd.Series, pd.Index)): return int(valor.memory_usage(deep=True))
+    if isinstance(valor, (bytes, bytearray)): return len(valor)
+    if isinstance(valor, dict): return sum(tamanho_bytes(v) for v in valor.values())
+    if isinstance(valor, (tuple, list)): return sum(tamanho_bytes(v) for v in valor)
+    return sys.getsizeof(valor)
+
+class VooUnico:
+    """
+    Deduplicação de um tipo de cálculo por chave (hash do conteúdo): enquanto o
+    cálculo de uma chave está em andamento, outras chamadas com a mesma chave
+    esperam o resultado dele em vez de repeti-lo.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._em_andamento: Dict[Hashable, Future] = {}
+
+    def _reservar(self, chave: Hashable) -> Tuple[Future, bool]:
+        """Futuro da chave e se esta chamada é a responsável pelo cálculo."""
+        with self._lock:
+            futuro = self._em_andamento.get(chave)
+            if futuro is not None: return futuro, False
+            futuro = self._em_andamento[chave] = Future()
+            return futuro, True
+
+    def _concluir(self, chave: Hashable, futuro: Future, resultado: Any = None, erro: BaseException = None):
+        if erro is None: futuro.set_result(resultado)
+        else: futuro.set_exception(erro)
+        with self._lock: self._em_andamento.pop(chave, None)
+
+    def executar(self, chave: Hashable, calcular: Callable[[], Any]) -> Any:
+        return self.executar_lote([chave], lambda _: [calcular()])[chave]
+
+    def executar_lote(self, chaves: List[Hashable], calcular: Callable[[List[Hashable]], List[Any]]) -> Dict[Hashable, Any]:
+        """
+        Resultados de várias chaves. As que ninguém está calculando vão numa única
+        chamada a `calcular` (que devolve os resultados na mesma ordem); as demais
+        esperam o cálculo em andamento.
+        """
+        reservas = {chave: self._reservar(chave) for chave in dict.fromkeys(chaves)}
+        proprias = [chave for chave, (_, dono) in reservas.items() if dono]
+        if proprias:
+            pendentes = dict.fromkeys(proprias)
+            erro = RuntimeError("o cálculo do lote não devolveu resultado para esta chave")
+            try:
+                calculados = list(calcular(proprias))
+                if len(calculados) != len(proprias):
+                    raise ValueError(f"calcular devolveu {len(calculados)} resultados para {len(proprias)} chaves")
+                for chave, resultado in zip(proprias, calculados):
+                    self._concluir(chave, reservas[chave][0], resultado)
+                    del pendentes[chave]
+            except BaseException as e:
+                erro = e
+                raise
+            finally:
+                # Nenhum futuro fica sem resposta: quem espera nele recebe o erro e refaz o cálculo
+                for chave in pendentes: self._concluir(chave, reservas[chave][0], erro=erro)
+
+        resultados = {}
+        for chave, (futuro, _) in reservas.items():
+            try:
+                resultados[chave] = futuro.result()
+            except BaseException:
+                # O cálculo da outra chamada falhou ou foi interrompido (ex.: rerun da sessão dela): refaz aqui
+                resultados.update(self.executar_lote([chave], calcular))
+        return resultados
+
+class CacheMemoria:
+    """
+    Cache LRU do processo limitado por bytes. Ao passar do limite descarta os
+    valores usados há mais tempo; cálculos simultâneos da mesma chave rodam uma
+    vez só (VooUnico). Os valores são compartilhados sem cópia.
+    """
+    def __init__(self, nome: str, limite_mb: int):
+        self.nome, self.limite_bytes = nome, limite_mb * 1024 * 1024
+        # RLock: a finalização de uma referência pode rodar (pelo coletor de lixo) com o lock já tomado pela mesma thread
+        self._lock = threading.RLock()
+        self._valores: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._calculos = VooUnico()
+        self.bytes = self.acertos = self.faltas = self.descartes = 0
+        CACHES[nome] = self
+
+    def obter(self, chave: Hashable, calcular: Callable[[], Any]) -> Any:
+        with self._lock:
+            if chave in self._valores:
+                self.acertos += 1
+                self._valores.move_to_end(chave)
+                return self._valores[chave][0]
+        propria = []
+        def calcular_aqui() -> Any:
+            propria.append(True)
+            return self._calcular_e_guardar(chave, calcular)
+        valor = self._calculos.executar(chave, calcular_aqui)
+        with self._lock:
+            # Sem cálculo próprio, o valor veio do cálculo em andamento de outra chamada: também é acerto
+            if not propria: self.acertos += 1
+            if chave in self._valores: self._valores.move_to_end(chave)
+        return valor
+
+    def _calcular_e_guardar(self, chave: Hashable, calcular: Callable[[], Any]) -> Any:
+        # Outra chamada pode ter guardado a chave entre a consulta em `obter` e a reserva do cálculo
+        with self._lock:
+            if chave in self._valores:
+                self.acertos += 1
+                return self._valores[chave][0]
+        return self._guardar(chave, calcular())
+
+    def _guardar(self, chave: Hashable, valor: Any) -> Any:
+        tamanho = tamanho_bytes(valor)
+        with self._lock:
+            self.faltas += 1
+            anterior = self._valores.pop(chave, None)
+            if anterior is not None: self.bytes -= anterior[1]
+            self._valores[chave] = (valor, tamanho)
+            self.bytes += tamanho
+            self._aplicar_limite(preservar=chave)
+        return valor
+
+    def _pode_descartar(self, chave: Hashable) -> bool:
+        return True
+
+    def _aplicar_limite(self, preservar: Hashable = None):
+        """Descarta do menos para o mais recente até caber no limite (`preservar`: valor recém-calculado)."""
+        for chave in list(self._valores):
+            if self.bytes <= self.limite_bytes: break
+            if chave == preservar or not self._pode_descartar(chave): continue
+            self.bytes -= self._valores.pop(chave)[1]
+            self.descartes += 1
+
+    def limpar(self):
+        """Descarta todas as entradas que podem ser descartadas (as métricas continuam)."""
+        with self._lock:
+            for chave in [c for c in self._valores if self._pode_descartar(c)]:
+                self.bytes -= self._valores.pop(chave)[1]
+                self.descartes += 1
+
+    def metricas(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entradas': len(self._valores), 'bytes': self.bytes, 'limite_bytes': self.limite_bytes,
+                    'acertos': self.acertos, 'faltas': self.faltas, 'descartes': self.descartes}
+
+    def entradas(self) -> List[Dict[str, Any]]:
+        """Chave, valor e tamanho (bytes, medido ao guardar) de cada entrada, da menos para a mais recente."""
+        with self._lock:
+            return [{'chave': chave, 'valor': valor, 'bytes': tamanho} for chave, (valor, tamanho) in self._valores.items()]
+
+class Referencia:
+    """Referência de uma sessão a um conjunto do armazém; `valor` é o objeto compartilhado."""
+    __slots__ = ('chave', 'valor', '__weakref__')
+
+    def __init__(self, chave: str, valor: Any):
+        self.chave, self.valor = chave, valor
+
+class ArmazemDados(CacheMemoria):
+    """CacheMemoria dos uploads, em que os conjuntos referenciados por alguma sessão ficam fixos."""
+    def __init__(self, nome: str = 'uploads', limite_mb: int = LIMITE_ARMAZEM_MB):
+        super().__init__(nome, limite_mb)
+        self._referencias: Dict[str, int] = {}
+
+    def obter(self, chave: str, calcular: Callable[[], Any]) -> Referencia:
+        """
+        Referência ao conjunto `chave`, calculado com `calcular()` se ainda não
+        estiver no armazém (uma única vez, mesmo com várias sessões pedindo juntas).
+        """
+        valor = super().obter(chave, calcular)
+        with self._lock:
+            referencia = Referencia(chave, valor)
+            self._referencias[chave] = self._referencias.get(chave, 0) + 1
+            weakref.finalize(referencia, self._liberar, chave)
+            return referencia
+
+    def _pode_descartar(self, chave: Hashable) -> bool:
+        return chave not in self._referencias
+
+    def _liberar(self, chave: str):
+        with self._lock:
+            self._referencias[chave] -= 1
+            if self._referencias[chave] > 0: return
+            del self._referencias[chave]
+            self._aplicar_limite()
+
+    def metricas(self) -> Dict[str, int]:
+        with self._lock:
+            return {**super().metricas(), 'em_uso': len(self._referencias)}
+
+    def entradas(self) -> List[Dict[str, Any]]:
+        """Como em CacheMemoria, com o nº de referências vivas ('sessoes') de cada conjunto."""
+        with self._lock:
+            return [{**entrada, 'sessoes': self._referencias.get(entrada['chave'], 0)} for entrada in super().entradas()]
+
+# Caches do processo por nome (para os painéis de diagnóstico)
+CACHES: Dict[str, CacheMemoria] = {}
+
+# Instâncias únicas do processo: este módulo é importado uma vez e vale para todas as sessões,
+# enquanto o script do painel é reexecutado a cada rerun (objetos criados nele não persistem)
+ARMAZEM_DADOS = ArmazemDados()
+
+# Leituras de planilhas em andamento, por digest: uploads simultâneos do mesmo arquivo são lidos uma vez só
+LEITURAS_PLANILHAS = VooUnico()
+
+# Caches do processo limitados por memória, com descarte do uso menos recente
+CACHE_DERIVADOS = CacheMemoria('derivados', LIMITE_DERIVADOS_MB)
+CACHE_EXPORTACOES = CacheMemoria('exportacoes', LIMITE_EXPORTACOES_MB)
@@ -0,0 +1,225 @@
+"""
+Benchmark ponta a ponta do painel APS sobre um conjunto de planilhas (reais ou
+geradas por `gerar_dados.py`): leitura, montagem dos cubos, vínculos, cada
+tabela de contagem e a renderização de cada aba. O resultado vai para um JSON.
+
+As abas rodam com o Streamlit em modo "bare" (sem servidor): os elementos não
+são enviados a um navegador, mas figuras, tabelas e cálculos são feitos como no
+painel. O cache em disco das planilhas usa uma pasta temporária própria.
+
+Uso:
+    python benchmarks/benchmark.py benchmarks/dados/100k
+    python benchmarks/benchmark.py benchmarks/dados/1m --repeticoes 1 --saida resultados_1m.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+# Antes de importar a ingestão: o cache Parquet do benchmark não se mistura com o do painel
+# (os processos de leitura reimportam este módulo e herdam a pasta pela variável de ambiente)
+if 'APS_BENCHMARK_CACHE' not in os.environ: os.environ['APS_BENCHMARK_CACHE'] = tempfile.mkdtemp(prefix='aps_benchmark_cache_')
+os.environ['APS_CACHE_DIR'] = os.environ['APS_BENCHMARK_CACHE']
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from ingestao import (
+    COL_FAMILIA_VINCULADA, COL_STATUS_DOC, COL_TEMPO_SEM_ATUALIZAR, COL_UNIDADE, DIRETORIO_CACHE, TIPO_CIDADAOS,
+    TIPO_DOMICILIOS, TIPO_PRODUTIVIDADE, concatenar_planilhas, hash_conteudo, processar_planilha, processar_planilhas,
+)
+from motor import (
+    ORDEM_CPF, ORDEM_TEMPO, calcular_vinculos, coluna_tipo_consulta, crosstab_observado, fatiar_periodo,
+    filtrar_cubo_cidadaos, gerar_relatorios, inferir_municipio, intervalo_datas, montar_cubo_cidadaos,
+    montar_cubo_producao, montar_matriz_tipos, parametros_do_municipio, perfil_unidades, scorecard_unidades,
+    tabela_categorias, tabela_consultas_esb, tabela_cubo_cidadaos, tabela_parametros,
+)
+
+VIEWS = ['menu', 'resumo', 'vinculo', 'tempo_cid', 'cpf', 'domicilios', 'familia_vinculada', 'producao', 'tipo_atendimento', 'consultas_esb']
+
+# ==============================================================================
+# 1. MEDIÇÃO
+# ==============================================================================
+
+def _linhas(valor: Any) -> Optional[int]:
+    if isinstance(valor, tuple): valor = valor[0]
+    return len(valor) if isinstance(valor, (pd.DataFrame, pd.Series, list)) else None
+
+class Medidor:
+    """Executa cada etapa `repeticoes` vezes e guarda o menor tempo, a mediana e as linhas de entrada/saída."""
+    def __init__(self, repeticoes: int):
+        self.repeticoes = repeticoes
+        self.etapas: List[Dict[str, Any]] = []
+
+    def medir(self, etapa: str, funcao: Callable[[], Any], linhas_entrada: Optional[int] = None, repeticoes: Optional[int] = None) -> Any:
+        tempos = []
+        for _ in range(repeticoes or self.repeticoes):
+            inicio = time.perf_counter()
+            resultado = funcao()
+            tempos.append(time.perf_counter() - inicio)
+        self.etapas.append({
+            'etapa': etapa, 'segundos': min(tempos), 'mediana': statistics.median(tempos), 'repeticoes': len(tempos),
+            'linhas_entrada': linhas_entrada, 'linhas_saida': _linhas(resultado),
+        })
+        print(f"  {etapa:<45} {min(tempos):9.3f} s")
+        return resultado
+
+# ==============================================================================
+# 2. ETAPAS
+# ==============================================================================
+
+def medir_ingestao(medidor: Medidor, caminhos: List[str]) -> Dict[str, pd.DataFrame]:
+    """Leitura fria (xlsx, no pool de processos como no painel), leitura do cache Parquet e concatenação por tipo."""
+    itens = []
+    for caminho in caminhos:
+        with open(caminho, 'rb') as arquivo: conteudo = arquivo.read()
+        itens.append((hash_conteudo(conteudo), conteudo))
+    medidor.medir('ingestao.xlsx', lambda: processar_planilhas(itens), repeticoes=1)
+    lidos = medidor.medir('ingestao.parquet', lambda: [processar_planilha(d, c) for d, c in itens])
+    frames: Dict[str, List[pd.DataFrame]] = {}
+    for tipo, df, _ in lidos:
+        if df is not None: frames.setdefault(tipo, []).append(df)
+    return {tipo: medidor.medir(f'concatenar.{tipo}', lambda lista=lista: concatenar_planilhas(lista), sum(map(len, lista)))
+            for tipo, lista in frames.items()}
+
+def medir_motor(medidor: Medidor, dados: Dict[str, pd.DataFrame], parametros: Dict[str, Any]):
+    df_cid, df_dom, df_prod = dados.get(TIPO_CIDADAOS), dados.get(TIPO_DOMICILIOS), dados.get(TIPO_PRODUTIVIDADE)
+    if df_cid is not None:
+        cubo, _, _ = medidor.medir('cidadaos.cubo', lambda: montar_cubo_cidadaos(df_cid), len(df_cid))
+        medidor.medir('cidadaos.vinculos', lambda: calcular_vinculos(cubo, parametros), len(cubo))
+        unidade = df_cid[COL_UNIDADE].iloc[0]
+        cubo_unidade = filtrar_cubo_cidadaos(cubo, unidade)
+        for col, ordem, nome in ((COL_TEMPO_SEM_ATUALIZAR, ORDEM_TEMPO, 'tempo'), (COL_STATUS_DOC, ORDEM_CPF, 'cpf')):
+            medidor.medir(f'cidadaos.crosstab_{nome}', lambda col=col, ordem=ordem: tabela_categorias(tabela_cubo_cidadaos(cubo, col), ordem), len(cubo))
+            medidor.medir(f'cidadaos.crosstab_{nome}_por_equipe', lambda col=col, ordem=ordem: tabela_categorias(
+                tabela_cubo_cidadaos(cubo_unidade, col, calcular_vinculos(cubo_unidade, parametros)), ordem), len(cubo_unidade))
+    if df_dom is not None:
+        grupo = df_dom['ESTABELECIMENTO_COMPLETO']
+        medidor.medir('domicilios.crosstab_tempo', lambda: tabela_categorias(crosstab_observado(grupo, df_dom[COL_TEMPO_SEM_ATUALIZAR]), ORDEM_TEMPO), len(df_dom))
+        ordem_familia = list(df_dom[COL_FAMILIA_VINCULADA].dropna().unique())
+        medidor.medir('domicilios.crosstab_familia', lambda: tabela_categorias(crosstab_observado(grupo, df_dom[COL_FAMILIA_VINCULADA]), ordem_familia), len(df_dom))
+    if df_prod is not None:
+        intervalo = intervalo_datas(df_prod) if 'DATA' in df_prod.columns else None
+        if intervalo:
+            inicio, fim = intervalo
+            metade = inicio + (fim - inicio) / 2
+            medidor.medir('producao.fatiar_periodo', lambda: fatiar_periodo(df_prod, inicio, metade), len(df_prod))
+        medidor.medir('producao.cubo', lambda: montar_cubo_producao(df_prod), len(df_prod))
+        matriz = medidor.medir('producao.matriz_tipos', lambda: montar_matriz_tipos(df_prod), len(df_prod))
+        if matriz is not None:
+            medidor.medir('producao.scorecard', lambda: scorecard_unidades(perfil_unidades(matriz)), len(matriz))
+        col_tipo_consulta = coluna_tipo_consulta(df_prod)
+        if col_tipo_consulta:
+            medidor.medir('producao.consultas_esb', lambda: tabela_consultas_esb(df_prod, col_tipo_consulta), len(df_prod))
+    medidor.medir('relatorios.todos', lambda: gerar_relatorios(parametros, df_cid, df_dom, df_prod))
+
+class ArquivoLocal:
+    """Arquivo do disco com a interface usada pelo painel nos uploads (name, file_id, getvalue)."""
+    def __init__(self, caminho: str):
+        self.name = self.file_id = os.path.basename(caminho)
+        with open(caminho, 'rb') as arquivo: self._conteudo = arquivo.read()
+
+    def getvalue(self) -> bytes:
+        return self._conteudo
+
+def medir_abas(medidor: Medidor, caminhos: List[str], municipio: str, parametros: Dict[str, Any]):
+    """Cada aba do painel: na primeira vez (calculando os dados derivados) e repetida (com eles em cache)."""
+    # Fora do servidor o st.fragment não executa a função decorada; aqui as abas rodam inteiras
+    st.fragment = lambda funcao=None, **_: funcao if funcao is not None else (lambda f: f)
+    import app
+    # Sem os avisos do modo "bare" e de parâmetros obsoletos a cada elemento (o Streamlit
+    # redefine o nível dos seus loggers ao ler a configuração, então eles são desativados)
+    for nome in ('streamlit.runtime.scriptrunner_utils.script_run_context', 'streamlit.deprecation_util'):
+        logging.getLogger(nome).disabled = True
+
+    arquivos = [ArquivoLocal(c) for c in caminhos]
+    st.session_state.logged_in = True
+
+    def painel_com_dados() -> 'app.DashboardAPS':
+        painel = app.DashboardAPS()
+        painel._processar_uploads(arquivos)
+        painel.municipio_selecionado, painel.parametros_municipio_atual = municipio, parametros
+        painel.parametro_oficial, painel.limite_oficial = parametros['PARAMETRO_ESF'], parametros['LIMITE_ESF']
+        return painel
+
+    medidor.medir('painel.uploads', painel_com_dados, repeticoes=1)
+    for view in VIEWS:
+        def renderizar(view=view):
+            st.session_state.view = view
+            painel_com_dados().render_dashboard_content()
+        app.CACHE_DERIVADOS.limpar()
+        try:
+            medidor.medir(f'aba.{view}', renderizar, repeticoes=1)
+            medidor.medir(f'aba.{view}.repetida', renderizar)
+        except Exception as e:
+            # Uma aba com erro (ex.: dependência opcional ausente) não interrompe as demais
+            print(f"Aviso: a aba '{view}' falhou: {e!r}")
+            medidor.etapas.append({'etapa': f'aba.{view}', 'erro': repr(e)})
+
+# ==============================================================================
+# 3. EXECUÇÃO
+# ==============================================================================
+
+def _versao(modulo: str) -> Optional[str]:
+    try:
+        return __import__(modulo).__version__
+    except Exception:
+        return None
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Mede o tempo de cada etapa do painel APS sobre uma pasta de planilhas.")
+    parser.add_argument('pasta', help="Pasta com as planilhas .xlsx (ex.: benchmarks/dados/100k)")
+    parser.add_argument('--saida', help="Arquivo JSON de resultado (padrão: benchmarks/resultados/<pasta>_<data>.json)")
+    parser.add_argument('--repeticoes', type=int, default=3, help="Repetições de cada etapa em memória (padrão: 3)")
+    parser.add_argument('--sem-abas', action='store_true', help="Não mede a renderização das abas")
+    args = parser.parse_args(argv)
+
+    caminhos = sorted(os.path.join(args.pasta, n) for n in os.listdir(args.pasta) if n.lower().endswith('.xlsx'))
+    if not caminhos: parser.error(f"nenhuma planilha .xlsx em {args.pasta}")
+    df_parametros = tabela_parametros()
+    municipio = inferir_municipio(caminhos, df_parametros['MUNICIPIO']) or df_parametros['MUNICIPIO'].iloc[0]
+    parametros = parametros_do_municipio(df_parametros, municipio)
+
+    medidor = Medidor(args.repeticoes)
+    print(f"{args.pasta}: {len(caminhos)} planilha(s), município {municipio}")
+    try:
+        dados = medir_ingestao(medidor, caminhos)
+        medir_motor(medidor, dados, parametros)
+        if not args.sem_abas: medir_abas(medidor, caminhos, municipio, parametros)
+    finally:
+        shutil.rmtree(DIRETORIO_CACHE, ignore_errors=True)
+
+    nome = os.path.basename(os.path.normpath(args.pasta))
+    saida = args.saida or os.path.join(RAIZ, 'benchmarks', 'resultados', f"{nome}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(saida)), exist_ok=True)
+    resultado = {
+        'conjunto': nome, 'gerado_em': datetime.now().isoformat(timespec='seconds'), 'municipio': municipio,
+        'ambiente': {
+            'python': platform.python_version(), 'plataforma': platform.platform(), 'cpus': os.cpu_count(),
+            'pandas': pd.__version__, 'numpy': np.__version__, 'streamlit': _versao('streamlit'),
+        },
+        'arquivos': [{'nome': os.path.basename(c), 'bytes': os.path.getsize(c)} for c in caminhos],
+        'linhas': {tipo: len(df) for tipo, df in dados.items()},
+        'pico_memoria_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'etapas': medidor.etapas,
+    }
+    with open(saida, 'w', encoding='utf-8') as arquivo:
+        json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+    print(f"Resultado gravado em {saida}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+Gerador de planilhas sintéticas no formato das exportações do e-SUS (cidadãos,
+domicílios e produtividade), para medir o desempenho sem dados reais.
+
+As planilhas têm as colunas que `ingestao.py` procura (e algumas a mais, como nas
+exportações reais). Acima do limite de linhas do Excel, cada relatório é dividido
+em vários arquivos (`_parte1`, `_parte2`, ...), como o painel aceita.
+
+Uso:
+    python benchmarks/gerar_dados.py 10k 100k --saida benchmarks/dados
+    python benchmarks/gerar_dados.py 5m --municipio "SANTA RITA" --semente 7
+"""
+
+import argparse
+import os
+import sys
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingestao import (
+    ABA_DETALHADO, COL_CIDADAO, COL_FAMILIA_VINCULADA, COL_INE, COL_NOME_EQUIPE, COL_STATUS_DOC,
+    COL_TEMPO_SEM_ATUALIZAR, COL_UNIDADE, DOM_COL_UNIDADE,
+)
+from motor import CATEGORIAS_ATENDIMENTO, CATEGORIAS_CONSULTA_ESB, LINHAS_MAXIMAS_XLSX, ORDEM_TEMPO, escrever_xlsx
+
+# ==============================================================================
+# 1. CONSTANTES
+# ==============================================================================
+
+TAMANHOS_PADRAO = ['10k', '100k', '1m', '5m']
+LINHAS_POR_ARQUIVO = LINHAS_MAXIMAS_XLSX - 1  # uma linha é o cabeçalho
+CIDADAOS_POR_EQUIPE = 3000  # ordem de grandeza dos parâmetros de ESF
+
+# Distribuições aproximadas das exportações reais
+PESOS_TEMPO = [0.45, 0.30, 0.15, 0.10]
+PESOS_CPF = {'Com CPF': 0.88, 'Sem CPF': 0.12}
+PESOS_FAMILIA = {'Sim': 0.8, 'Não': 0.2}
+CBOS = {
+    'AGENTE COMUNITÁRIO DE SAÚDE': 0.35, 'TÉCNICO DE ENFERMAGEM': 0.2, 'ENFERMEIRO': 0.18,
+    'MÉDICO DA ESTRATÉGIA DE SAÚDE DA FAMÍLIA': 0.15, 'CIRURGIÃO DENTISTA': 0.08, 'TÉCNICO EM SAÚDE BUCAL': 0.04,
+}
+TIPOS_ATENDIMENTO = list(CATEGORIAS_ATENDIMENTO) + ['VISITA DOMICILIAR']
+
+# ==============================================================================
+# 2. ESTRUTURA DO MUNICÍPIO E GERAÇÃO DAS LINHAS
+# ==============================================================================
+
+def estrutura_municipio(n_cidadaos: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Equipes (unidade, nome, INE de 7 dígitos e peso no nº de cadastros) dimensionadas pelo nº de cidadãos."""
+    n_equipes = max(3, n_cidadaos // CIDADAOS_POR_EQUIPE)
+    n_unidades = max(2, n_equipes // 2)
+    unidade = np.sort(rng.integers(0, n_unidades, n_equipes))
+    equipes = pd.DataFrame({
+        'unidade': [f"UBS {u + 1:03d}" for u in unidade],
+        'nome': [f"ESF {i + 1:03d}" for i in range(n_equipes)],
+        'ine': [f"{1_000_000 + i:07d}" for i in range(n_equipes)],
+        # Algumas equipes com muito mais cadastros que outras, como nos municípios reais
+        'peso': rng.lognormal(0, 0.35, n_equipes),
+    })
+    equipes['peso'] /= equipes['peso'].sum()
+    return equipes
+
+def _sortear(rng: np.random.Generator, pesos: Dict[str, float], n: int) -> np.ndarray:
+    valores = np.array(list(pesos), dtype=object)
+    return valores[rng.choice(len(valores), n, p=np.array(list(pesos.values())) / sum(pesos.values()))]
+
+def gerar_cidadaos(n: int, inicio: int, equipes: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+    """Aba DETALHADO do relatório de cadastro individual; `inicio` numera os cidadãos entre as partes."""
+    equipe = equipes.iloc[rng.choice(len(equipes), n, p=equipes['peso'])]
+    cidadao = np.array([f"CIDADÃO {i:08d}" for i in range(inicio, inicio + n)], dtype=object)
+    cidadao[rng.random(n) < 0.002] = None  # registros sem nome são descartados na leitura
+    return pd.DataFrame({
+        'CNS': rng.integers(700_000_000_000_000, 799_999_999_999_999, n).astype(str),
+        COL_CIDADAO: cidadao,
+        'SEXO': _sortear(rng, {'Feminino': 0.52, 'Masculino': 0.48}, n),
+        'DATA DE NASCIMENTO': (pd.Timestamp('1930-01-01') + pd.to_timedelta(rng.integers(0, 34_000, n), 'D')).strftime('%d/%m/%Y'),
+        COL_STATUS_DOC: _sortear(rng, PESOS_CPF, n),
+        COL_TEMPO_SEM_ATUALIZAR: _sortear(rng, dict(zip([t.capitalize() for t in ORDEM_TEMPO], PESOS_TEMPO)), n),
+        COL_UNIDADE: equipe['unidade'].to_numpy(),
+        COL_NOME_EQUIPE: equipe['nome'].to_numpy(),
+        COL_INE: equipe['ine'].to_numpy(),
+        'MICROÁREA': rng.integers(1, 13, n).astype(str),
+    })
+
+def gerar_domicilios(n: int, equipes: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+    """Aba DETALHADO do relatório de cadastro domiciliar."""
+    equipe = equipes.iloc[rng.choice(len(equipes), n, p=equipes['peso'])]
+    return pd.DataFrame({
+        DOM_COL_UNIDADE: equipe['unidade'].to_numpy(),
+        COL_INE: equipe['ine'].to_numpy(),
+        'LOGRADOURO': [f"RUA {i:04d}" for i in rng.integers(1, 2000, n)],
+        COL_TEMPO_SEM_ATUALIZAR: _sortear(rng, dict(zip(ORDEM_TEMPO, PESOS_TEMPO)), n),
+        COL_FAMILIA_VINCULADA: _sortear(rng, PESOS_FAMILIA, n),
+    })
+
+def gerar_producao(n: int, equipes: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+    """Relatório de produtividade (primeira aba), com atendimentos de um trimestre."""
+    equipe = equipes.iloc[rng.integers(0, len(equipes), n)]
+    cbo = _sortear(rng, CBOS, n)
+    odonto = np.isin(cbo, ['CIRURGIÃO DENTISTA', 'TÉCNICO EM SAÚDE BUCAL'])
+    profissional = np.array([f"PROFISSIONAL {i:05d}" for i in rng.integers(0, len(equipes) * 8, n)], dtype=object)
+    profissional[rng.random(n) < 0.01] = None
+    tipo_consulta = np.where(odonto, rng.choice(np.array(CATEGORIAS_CONSULTA_ESB, dtype=object), n), 'Não informado')
+    return pd.DataFrame({
+        'DATA': pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 90 * 24, n), 'h'),
+        'ESTABELECIMENTO': equipe['unidade'].to_numpy(),
+        'EQUIPE': equipe['nome'].to_numpy(),
+        'INE': equipe['ine'].to_numpy(),
+        'DESCRIÇÃO DO CBO': cbo,
+        'PROFISSIONAL': profissional,
+        'TIPO DE ATENDIMENTO': rng.choice(np.array(TIPOS_ATENDIMENTO, dtype=object), n),
+        'TIPO DE CONSULTA': tipo_consulta,
+        'TOTAL GERAL': rng.integers(1, 6, n),
+    })
+
+# ==============================================================================
+# 3. ESCRITA DOS ARQUIVOS
+# ==============================================================================
+
+def _partes(n_linhas: int) -> List[int]:
+    return [min(LINHAS_POR_ARQUIVO, n_linhas - i) for i in range(0, n_linhas, LINHAS_POR_ARQUIVO)]
+
+def _nome_arquivo(relatorio: str, municipio: str, parte: int, n_partes: int) -> str:
+    sufixo = f"_parte{parte + 1}" if n_partes > 1 else ""
+    return f"{relatorio}_{municipio}{sufixo}.xlsx"
+
+def gerar_conjunto(n_linhas: int, pasta: str, municipio: str, semente: int) -> List[str]:
+    """
+    Grava cidadãos (`n_linhas`), domicílios (um terço) e produção (`n_linhas`) de
+    um município em `pasta`, parte a parte, e devolve os caminhos gerados.
+    """
+    rng = np.random.default_rng(semente)
+    equipes = estrutura_municipio(n_linhas, rng)
+    os.makedirs(pasta, exist_ok=True)
+    caminhos = []
+    relatorios = [
+        ('cidadaos', n_linhas, ABA_DETALHADO, lambda n, inicio: gerar_cidadaos(n, inicio, equipes, rng)),
+        ('domicilios', max(1, n_linhas // 3), ABA_DETALHADO, lambda n, inicio: gerar_domicilios(n, equipes, rng)),
+        ('producao', n_linhas, 'Produtividade', lambda n, inicio: gerar_producao(n, equipes, rng)),
+    ]
+    for relatorio, total, aba, gerar in relatorios:
+        partes = _partes(total)
+        inicio = 0
+        for i, n in enumerate(partes):
+            caminho = os.path.join(pasta, _nome_arquivo(relatorio, municipio, i, len(partes)))
+            escrever_xlsx(gerar(n, inicio), caminho, aba=aba)
+            caminhos.append(caminho)
+            inicio += n
+            print(f"  {os.path.basename(caminho)}: {n} linhas")
+    return caminhos
+
+def linhas_do_tamanho(texto: str) -> int:
+    """'10k' -> 10000, '5m' -> 5000000 (também aceita números simples)."""
+    texto = texto.strip().lower().replace('_', '')
+    multiplicador = {'k': 1_000, 'm': 1_000_000}.get(texto[-1:], 1)
+    try:
+        return int(float(texto.rstrip('km')) * multiplicador)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"tamanho inválido: {texto}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Gera planilhas sintéticas do e-SUS para benchmarks.")
+    parser.add_argument('tamanhos', nargs='*', default=TAMANHOS_PADRAO, help=f"Nº de linhas por conjunto (padrão: {' '.join(TAMANHOS_PADRAO)})")
+    parser.add_argument('--saida', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dados'), help="Pasta de saída; cada tamanho vai numa subpasta")
+    parser.add_argument('--municipio', default='ALHANDRA', help="Município no nome dos arquivos (padrão: ALHANDRA)")
+    parser.add_argument('--semente', type=int, default=42, help="Semente do gerador aleatório")
+    args = parser.parse_args(argv)
+
+    for tamanho in args.tamanhos:
+        n_linhas = linhas_do_tamanho(tamanho)
+        pasta = os.path.join(args.saida, tamanho.lower())
+        print(f"{tamanho} ({n_linhas} linhas) -> {pasta}")
+        gerar_conjunto(n_linhas, pasta, args.municipio, args.semente)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
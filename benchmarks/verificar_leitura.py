@@ -0,0 +1,105 @@
+"""
+Confere que a leitura em streaming da aba DETALHADO (`ler_colunas_detalhado`)
+devolve a mesma tabela que o `pd.read_excel` de antes: mesmos valores, mesmos
+tipos e as mesmas células ausentes, inclusive os textos que o pandas lê como
+ausentes ('NA', 'N/A', 'NULL', '#N/A', 'nan'...).
+
+Sem argumentos, usa uma planilha montada aqui com esses textos; com pastas ou
+arquivos .xlsx, confere também cada planilha de cidadãos e de domicílios.
+
+Uso:
+    python benchmarks/verificar_leitura.py
+    python benchmarks/verificar_leitura.py benchmarks/dados/10k
+"""
+
+import argparse
+import io
+import os
+import sys
+from typing import List, Optional
+
+import openpyxl
+import pandas as pd
+from pandas._libs.parsers import STR_NA_VALUES
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingestao import ABA_DETALHADO, COLUNAS_CIDADAOS, COLUNAS_DOMICILIOS, ler_colunas_detalhado
+
+# ==============================================================================
+# 1. COMPARAÇÃO
+# ==============================================================================
+
+def _ausentes_como_none(df: pd.DataFrame) -> pd.DataFrame:
+    # O read_excel marca as ausências com NaN e a leitura em streaming com None
+    return df.astype(object).where(df.notna(), None)
+
+def comparar(conteudo: bytes, colunas: List[str]) -> Optional[str]:
+    """Diferença entre a leitura antiga e a em streaming (None se forem iguais)."""
+    novo = ler_colunas_detalhado(conteudo, colunas)
+    if novo is None: return "colunas ausentes no cabeçalho"
+    antigo = pd.read_excel(io.BytesIO(conteudo), sheet_name=ABA_DETALHADO)
+    antigo.columns = antigo.columns.str.strip()
+    antigo = antigo[colunas]
+    if not antigo.dtypes.equals(novo.dtypes):
+        return f"tipos diferentes: {antigo.dtypes.to_dict()} x {novo.dtypes.to_dict()}"
+    try:
+        pd.testing.assert_frame_equal(_ausentes_como_none(antigo), _ausentes_como_none(novo))
+    except AssertionError as e:
+        return str(e)
+    return None
+
+def planilha_com_ausentes() -> bytes:
+    """Aba DETALHADO de cidadãos com cada texto de ausência do pandas em todas as colunas."""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = ABA_DETALHADO
+    ws.append(COLUNAS_CIDADAOS + ['OUTRA'])
+    # As variações no fim (com espaços ou outra grafia) o pandas mantém como texto
+    textos = sorted(STR_NA_VALUES) + [' NA ', 'N/A ', 'na', 'Nulo']
+    for i, texto in enumerate(textos):
+        ws.append(['ATUALIZADO', texto, 'UBS A', 'EQUIPE 1', 1000 + i, f'CIDADÃO {i}', texto])
+        ws.append([texto, 'ATÉ 1 ANO', texto, 'EQUIPE 2', 2000 + i, texto, None])
+    ws.append(['ATUALIZADO', 'ATÉ 1 ANO', 'UBS A', 'EQUIPE 1', 'NA', 'CIDADÃO', None])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+# ==============================================================================
+# 2. EXECUÇÃO
+# ==============================================================================
+
+def _arquivos(caminhos: List[str]) -> List[str]:
+    arquivos = []
+    for caminho in caminhos:
+        if os.path.isdir(caminho):
+            arquivos.extend(sorted(os.path.join(caminho, n) for n in os.listdir(caminho) if n.lower().endswith('.xlsx')))
+        else:
+            arquivos.append(caminho)
+    return arquivos
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compara a leitura em streaming da aba DETALHADO com o pd.read_excel.")
+    parser.add_argument('caminhos', nargs='*', help="Pastas ou arquivos .xlsx a conferir além da planilha de teste")
+    args = parser.parse_args(argv)
+
+    falhas = 0
+    casos = [("planilha de teste com textos ausentes", planilha_com_ausentes(), [COLUNAS_CIDADAOS])]
+    for arquivo in _arquivos(args.caminhos):
+        with open(arquivo, 'rb') as f: casos.append((arquivo, f.read(), [COLUNAS_CIDADAOS, COLUNAS_DOMICILIOS]))
+    for nome, conteudo, conjuntos in casos:
+        wb = openpyxl.load_workbook(io.BytesIO(conteudo), read_only=True)
+        tem_detalhado = ABA_DETALHADO in wb.sheetnames
+        wb.close()
+        if not tem_detalhado: continue
+        for colunas in conjuntos:
+            if ler_colunas_detalhado(conteudo, colunas) is None: continue
+            diferenca = comparar(conteudo, colunas)
+            print(f"{'OK   ' if diferenca is None else 'FALHA'} {nome}")
+            if diferenca is not None:
+                print(diferenca)
+                falhas += 1
+    return 1 if falhas else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
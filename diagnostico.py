@@ -0,0 +1,310 @@
+"""
+Instrumentação leve das etapas do painel: tempo de parede, linhas de entrada e
+saída e acerto ou falta de cache de cada etapa de uma execução (rerun). Para
+investigar uma execução lenta, `Perfilador` grava o perfil completo dela, e
+`HistoricoMemoria` acompanha a memória residente (RSS) do processo.
+`RegistroLatencias` guarda o tempo de todas as execuções num SQLite local, para
+os percentis de latência por aba.
+
+As etapas são marcadas com `with etapa('nome', linhas_entrada) as registro:` em
+qualquer ponto do código; fora de um `Rastreador` ativo (diagnóstico desligado)
+elas não fazem nada. O rastreador da execução corrente fica numa ContextVar,
+então sessões simultâneas (uma thread cada) não se misturam.
+
+Este módulo não depende do Streamlit.
+"""
+
+import cProfile
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import closing, contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+# Liga o diagnóstico (tempos por etapa, páginas de memória e latência, botão de perfil da próxima execução)
+DIAGNOSTICO_ATIVO = os.environ.get('APS_DIAGNOSTICO', '').strip().lower() in ('1', 'true', 'sim')
+# Registra a latência de cada execução no SQLite (ligado também pelo diagnóstico)
+LATENCIAS_ATIVO = DIAGNOSTICO_ATIVO or os.environ.get('APS_LATENCIAS', '').strip().lower() in ('1', 'true', 'sim')
+# Dias que as latências ficam no SQLite (as mais antigas são apagadas ao registrar)
+VALIDADE_LATENCIAS_DIAS = int(os.environ.get('APS_LATENCIAS_DIAS', 90))
+# Perfila todas as execuções (sem isso, só a pedida no painel de diagnóstico)
+PERFIL_ATIVO = os.environ.get('APS_PERFIL', '').strip().lower() in ('1', 'true', 'sim')
+# Pasta dos registros de diagnóstico (o JSONL das etapas de cada execução e a subpasta dos perfis)
+DIRETORIO_DIAGNOSTICO = os.environ.get('APS_DIAGNOSTICO_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.diagnostico'))
+ARQUIVO_ETAPAS = 'etapas.jsonl'
+# Tamanho a partir do qual o JSONL das etapas é rotacionado (o anterior fica em `etapas.jsonl.1`)
+LIMITE_ETAPAS_MB = int(os.environ.get('APS_DIAGNOSTICO_MB', 50))
+ARQUIVO_LATENCIAS = 'latencias.sqlite'
+PASTA_PERFIS = 'perfis'
+INTERVALO_AMOSTRAGEM = 0.005  # segundos entre amostras da pilha da execução perfilada
+INTERVALO_MEMORIA = 5  # segundos entre leituras da memória do processo
+AMOSTRAS_MEMORIA = 720  # leituras guardadas (1 hora com o intervalo padrão)
+PERCENTIS_LATENCIA = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+INTERVALO_LIMPEZA_LATENCIAS = 3600  # segundos entre as remoções das latências vencidas
+
+def contar_linhas(valor: Any) -> Optional[int]:
+    """Nº de linhas de um frame ou série (somado sobre tuplas de frames); None para outros valores."""
+    if isinstance(valor, (pd.DataFrame, pd.Series)): return len(valor)
+    if isinstance(valor, tuple):
+        linhas = [n for n in map(contar_linhas, valor) if n is not None]
+        return sum(linhas) if linhas else None
+    return None
+
+class Etapa:
+    """Registro de uma etapa; `linhas_saida` e `cache` são preenchidos por quem a mede."""
+    __slots__ = ('nome', 'nivel', 'segundos', 'linhas_entrada', 'linhas_saida', 'cache')
+
+    def __init__(self, nome: str, nivel: int = 0, linhas_entrada: Optional[int] = None):
+        self.nome, self.nivel, self.linhas_entrada = nome, nivel, linhas_entrada
+        self.segundos: Optional[float] = None
+        self.linhas_saida: Optional[int] = None
+        self.cache: Optional[str] = None  # 'acerto' ou 'falta'
+
+    def como_dict(self) -> Dict[str, Any]:
+        return {campo: getattr(self, campo) for campo in self.__slots__}
+
+_RASTREADOR: ContextVar[Optional["Rastreador"]] = ContextVar('rastreador_aps', default=None)
+# Etapa descartada, devolvida quando não há rastreador ativo (as atribuições a ela se perdem)
+_ETAPA_INATIVA = nullcontext(Etapa('inativa'))
+_LOCK_ARQUIVO = threading.Lock()
+
+class Rastreador:
+    """Etapas de uma execução, na ordem em que começaram; ativo dentro de um bloco `with`."""
+    def __init__(self):
+        self.etapas: List[Etapa] = []
+        self._nivel = 0
+        self._token = None
+
+    def __enter__(self) -> "Rastreador":
+        self._token = _RASTREADOR.set(self)
+        return self
+
+    def __exit__(self, *_):
+        _RASTREADOR.reset(self._token)
+
+    @contextmanager
+    def etapa(self, nome: str, linhas_entrada: Optional[int] = None) -> Iterator[Etapa]:
+        registro = Etapa(nome, self._nivel, linhas_entrada)
+        self.etapas.append(registro)
+        self._nivel += 1
+        inicio = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            registro.segundos = time.perf_counter() - inicio
+            self._nivel -= 1
+
+    def tabela(self) -> pd.DataFrame:
+        """Etapas para exibição, com o nome recuado pelo nível de aninhamento."""
+        return pd.DataFrame({
+            'Etapa': ['· ' * e.nivel + e.nome for e in self.etapas],
+            'Tempo (ms)': [None if e.segundos is None else round(e.segundos * 1000, 1) for e in self.etapas],
+            'Linhas (entrada)': pd.array([e.linhas_entrada for e in self.etapas], dtype='Int64'),
+            'Linhas (saída)': pd.array([e.linhas_saida for e in self.etapas], dtype='Int64'),
+            'Cache': [e.cache or '' for e in self.etapas],
+        })
+
+    def gravar(self, **contexto: Any) -> Optional[str]:
+        """
+        Acrescenta a execução (contexto + etapas) como uma linha do JSONL de diagnóstico
+        e devolve o caminho. Passando de LIMITE_ETAPAS_MB, o arquivo vira `.1` (substituindo
+        a rotação anterior) e um novo é começado: o disco usado fica em até duas vezes o limite.
+        """
+        caminho = os.path.join(DIRETORIO_DIAGNOSTICO, ARQUIVO_ETAPAS)
+        linha = json.dumps({
+            'momento': datetime.now().isoformat(timespec='seconds'), **contexto,
+            'etapas': [e.como_dict() for e in self.etapas],
+        }, ensure_ascii=False, default=str)
+        try:
+            os.makedirs(DIRETORIO_DIAGNOSTICO, exist_ok=True)
+            with _LOCK_ARQUIVO:
+                if os.path.exists(caminho) and os.path.getsize(caminho) >= LIMITE_ETAPAS_MB * 1024 * 1024:
+                    os.replace(caminho, f"{caminho}.1")
+                with open(caminho, 'a', encoding='utf-8') as arquivo: arquivo.write(linha + '\n')
+        except OSError as e:
+            print(f"Aviso: não foi possível gravar o diagnóstico em {caminho}: {e}")
+            return None
+        return caminho
+
+def etapa(nome: str, linhas_entrada: Optional[int] = None):
+    """Mede uma etapa no rastreador da execução corrente (sem rastreador, não faz nada)."""
+    rastreador = _RASTREADOR.get()
+    return _ETAPA_INATIVA if rastreador is None else rastreador.etapa(nome, linhas_entrada)
+
+class Perfilador:
+    """
+    Perfil de uma execução, ativo dentro de um bloco `with` na thread que a executa:
+    cProfile (tempos por função, para o pstats/snakeviz) e, numa thread auxiliar,
+    amostras periódicas da pilha dessa thread, agregadas no formato "collapsed"
+    (uma pilha por linha, `raiz;...;folha contagem`) do flamegraph.pl e do speedscope.
+    """
+    def __init__(self, intervalo: float = INTERVALO_AMOSTRAGEM):
+        self.intervalo = intervalo
+        self.amostras: Counter = Counter()
+        self._perfil: Optional[cProfile.Profile] = cProfile.Profile()
+        self._parar = threading.Event()
+        self._amostrador: Optional[threading.Thread] = None
+        self._thread_alvo: Optional[int] = None
+
+    def __enter__(self) -> "Perfilador":
+        self._thread_alvo = threading.get_ident()
+        self._amostrador = threading.Thread(target=self._amostrar, name='perfilador_aps', daemon=True)
+        self._amostrador.start()
+        try:
+            self._perfil.enable()
+        except ValueError as e:  # outro perfilador já ativo neste interpretador
+            print(f"Aviso: cProfile indisponível, só as amostras de pilha serão gravadas: {e}")
+            self._perfil = None
+        return self
+
+    def __exit__(self, *_):
+        if self._perfil is not None: self._perfil.disable()
+        self._parar.set()
+        self._amostrador.join()
+
+    def _amostrar(self):
+        while not self._parar.wait(self.intervalo):
+            quadro = sys._current_frames().get(self._thread_alvo)
+            pilha = []
+            while quadro is not None:
+                codigo = quadro.f_code
+                pilha.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+                quadro = quadro.f_back
+            if pilha: self.amostras[';'.join(reversed(pilha))] += 1
+
+    def gravar(self, **rotulos: Any) -> List[str]:
+        """
+        Grava `<momento>_<rótulos>.pstats` e `.folded` na pasta de perfis e devolve
+        os caminhos gravados. Os rótulos (ex.: aba, município, nº de linhas) vão no nome.
+        """
+        nome = '_'.join([datetime.now().strftime('%Y%m%d-%H%M%S-%f')] + [str(v) for v in rotulos.values()])
+        base = os.path.join(DIRETORIO_DIAGNOSTICO, PASTA_PERFIS, re.sub(r'[^\w.-]+', '_', nome))
+        gravados = []
+        try:
+            os.makedirs(os.path.dirname(base), exist_ok=True)
+            if self._perfil is not None:
+                self._perfil.dump_stats(f"{base}.pstats")
+                gravados.append(f"{base}.pstats")
+            with open(f"{base}.folded", 'w', encoding='utf-8') as arquivo:
+                for pilha, contagem in sorted(self.amostras.items()): arquivo.write(f"{pilha} {contagem}\n")
+            gravados.append(f"{base}.folded")
+        except OSError as e:
+            print(f"Aviso: não foi possível gravar o perfil em {base}: {e}")
+        return gravados
+
+def memoria_processo() -> Dict[str, int]:
+    """Memória residente atual ('rss') e pico ('pico') do processo em bytes, de /proc/self/status (Linux)."""
+    campos = {'VmRSS:': 'rss', 'VmHWM:': 'pico'}
+    memoria = {}
+    try:
+        with open('/proc/self/status', encoding='ascii') as arquivo:
+            for linha in arquivo:
+                partes = linha.split()
+                if partes and partes[0] in campos: memoria[campos[partes[0]]] = int(partes[1]) * 1024
+    except OSError:
+        pass
+    return memoria
+
+class HistoricoMemoria:
+    """Leituras periódicas da memória do processo numa thread auxiliar, guardadas em janela (as últimas N)."""
+    def __init__(self, intervalo: float = INTERVALO_MEMORIA, maximo: int = AMOSTRAS_MEMORIA):
+        self.intervalo = intervalo
+        self.leituras: deque = deque(maxlen=maximo)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def iniciar(self):
+        """Inicia as leituras (uma vez por processo; chamadas seguintes não fazem nada)."""
+        with self._lock:
+            if self._thread is not None: return
+            self._thread = threading.Thread(target=self._ler, name='memoria_aps', daemon=True)
+            self._thread.start()
+
+    def _ler(self):
+        while True:
+            memoria = memoria_processo()
+            if 'rss' in memoria: self.leituras.append((datetime.now(), memoria['rss']))
+            time.sleep(self.intervalo)
+
+    def tabela(self) -> pd.DataFrame:
+        """RSS (MB) por momento da leitura."""
+        leituras = list(self.leituras)
+        return pd.DataFrame({'RSS (MB)': [rss / 1024 ** 2 for _, rss in leituras]}, index=pd.DatetimeIndex([m for m, _ in leituras], name='Momento'))
+
+class RegistroLatencias:
+    """
+    Tempo de parede de cada execução do painel, com a aba, o município, os filtros
+    e o nº de linhas dos dados, numa tabela SQLite local (uma conexão por operação,
+    então pode ser usado por várias sessões e processos ao mesmo tempo). Guarda
+    os últimos `validade_dias` dias.
+    """
+    def __init__(self, caminho: Optional[str] = None, validade_dias: int = VALIDADE_LATENCIAS_DIAS):
+        self.caminho = caminho or os.path.join(DIRETORIO_DIAGNOSTICO, ARQUIVO_LATENCIAS)
+        self.validade_dias = validade_dias
+        self._lock = threading.Lock()
+        self._tabela_criada = False
+        self._ultima_limpeza: Optional[float] = None
+
+    def _conectar(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.caminho), exist_ok=True)
+        conexao = sqlite3.connect(self.caminho, timeout=5)
+        if not self._tabela_criada:
+            # WAL: gravações curtas sem bloquear as leituras da página de latência
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute(
+                "CREATE TABLE IF NOT EXISTS execucoes (momento TEXT NOT NULL, view TEXT, municipio TEXT, filtros TEXT,"
+                " linhas_cid INTEGER, linhas_dom INTEGER, linhas_prod INTEGER, segundos REAL NOT NULL)"
+            )
+            conexao.execute("CREATE INDEX IF NOT EXISTS execucoes_momento ON execucoes (momento)")
+            self._tabela_criada = True
+        conexao.execute("PRAGMA synchronous=NORMAL")
+        return conexao
+
+    def registrar(self, segundos: float, view: Optional[str], municipio: Optional[str], filtros: Dict[str, Any], linhas: Dict[str, Optional[int]]):
+        """Acrescenta uma execução; `linhas` tem as chaves 'cid', 'dom' e 'prod'."""
+        registro = (
+            datetime.now().isoformat(timespec='milliseconds'), view, municipio, json.dumps(filtros, ensure_ascii=False, default=str),
+            linhas.get('cid'), linhas.get('dom'), linhas.get('prod'), segundos,
+        )
+        try:
+            with self._lock, closing(self._conectar()) as conexao, conexao:
+                conexao.execute("INSERT INTO execucoes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", registro)
+                if self._ultima_limpeza is None or time.monotonic() - self._ultima_limpeza >= INTERVALO_LIMPEZA_LATENCIAS:
+                    limite = datetime.now() - timedelta(days=self.validade_dias)
+                    conexao.execute("DELETE FROM execucoes WHERE momento < ?", (limite.isoformat(timespec='milliseconds'),))
+                    self._ultima_limpeza = time.monotonic()
+        except sqlite3.Error as e:
+            print(f"Aviso: não foi possível registrar a latência em {self.caminho}: {e}")
+
+    def carregar(self, desde: Optional[datetime] = None) -> pd.DataFrame:
+        """Execuções registradas (a partir de `desde`), com `momento` como data e hora."""
+        consulta, parametros = "SELECT * FROM execucoes", ()
+        if desde is not None: consulta, parametros = consulta + " WHERE momento >= ?", (desde.isoformat(timespec='milliseconds'),)
+        try:
+            with closing(self._conectar()) as conexao:
+                return pd.read_sql_query(consulta, conexao, params=parametros, parse_dates=['momento'])
+        except sqlite3.Error as e:
+            print(f"Aviso: não foi possível ler as latências de {self.caminho}: {e}")
+            return pd.DataFrame(columns=['momento', 'view', 'municipio', 'filtros', 'linhas_cid', 'linhas_dom', 'linhas_prod', 'segundos'])
+
+def percentis_latencia(execucoes: pd.DataFrame, por: List[Any]) -> pd.DataFrame:
+    """Nº de execuções, p50/p95/p99 e máximo (segundos) de `execucoes` agrupadas por `por` (colunas ou Grouper)."""
+    grupos = execucoes.groupby(por, observed=True)['segundos']
+    return pd.DataFrame({
+        'execucoes': grupos.size(),
+        **{nome: grupos.quantile(q) for nome, q in PERCENTIS_LATENCIA.items()},
+        'max': grupos.max(),
+    })
+
+# Instâncias únicas do processo (o módulo é importado uma vez; o script do painel é reexecutado a cada rerun)
+HISTORICO_MEMORIA = HistoricoMemoria()
+REGISTRO_LATENCIAS = RegistroLatencias()
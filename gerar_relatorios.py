@@ -0,0 +1,113 @@
+"""
+Geração em lote dos relatórios do painel APS, sem navegador.
+
+Lê todas as planilhas do e-SUS (.xlsx) de uma pasta, agrupa-as por município
+(pelo nome do arquivo, como no painel) e grava as tabelas de cada município em
+`<saida>/<MUNICÍPIO>/<tabela>.xlsx` (ou .csv).
+
+Uso:
+    python gerar_relatorios.py planilhas/ --saida relatorios/
+    python gerar_relatorios.py planilhas/ --municipio ALHANDRA --formato csv
+"""
+
+import argparse
+import os
+import sys
+from datetime import date
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from ingestao import TIPO_CIDADAOS, TIPO_DOMICILIOS, TIPO_PRODUTIVIDADE, concatenar_planilhas, hash_conteudo, processar_planilhas
+from motor import (
+    LINHAS_MAXIMAS_XLSX, escrever_csv, escrever_xlsx, gerar_relatorios, inferir_municipio, parametros_do_municipio,
+    tabela_parametros,
+)
+
+def _listar_planilhas(pasta: str) -> List[str]:
+    return sorted(
+        os.path.join(pasta, nome) for nome in os.listdir(pasta)
+        if nome.lower().endswith('.xlsx') and not nome.startswith('~$')
+    )
+
+def _agrupar_por_municipio(caminhos: List[str], municipios: List[str], municipio_fixo: Optional[str]) -> Dict[str, List[str]]:
+    """Arquivos de cada município. Com `municipio_fixo`, todos os arquivos vão para ele."""
+    grupos: Dict[str, List[str]] = {}
+    for caminho in caminhos:
+        municipio = municipio_fixo or inferir_municipio([caminho], municipios)
+        if municipio is None:
+            print(f"Aviso: município não identificado pelo nome do arquivo, ignorado: {os.path.basename(caminho)}")
+            continue
+        grupos.setdefault(municipio, []).append(caminho)
+    return grupos
+
+def _ler_planilhas(caminhos: List[str]) -> Dict[str, pd.DataFrame]:
+    """Lê (em paralelo e com o cache em disco da ingestão) e concatena as planilhas por tipo."""
+    itens = []
+    for caminho in caminhos:
+        with open(caminho, 'rb') as arquivo: conteudo = arquivo.read()
+        itens.append((hash_conteudo(conteudo), conteudo))
+    frames: Dict[str, List[pd.DataFrame]] = {}
+    for caminho, (tipo, df, erro) in zip(caminhos, processar_planilhas(itens)):
+        if erro: print(f"Aviso: {os.path.basename(caminho)}: {erro}")
+        if df is not None: frames.setdefault(tipo, []).append(df)
+    return {tipo: concatenar_planilhas(lista) for tipo, lista in frames.items()}
+
+def _gravar_tabela(df: pd.DataFrame, pasta: str, nome: str, formato: str) -> str:
+    if formato == 'xlsx' and len(df) >= LINHAS_MAXIMAS_XLSX:
+        print(f"Aviso: '{nome}' tem {len(df)} linhas e não cabe numa planilha do Excel; gravando em CSV.")
+        formato = 'csv'
+    caminho = os.path.join(pasta, f"{nome}.{formato}")
+    (escrever_xlsx if formato == 'xlsx' else escrever_csv)(df, caminho)
+    return caminho
+
+def _data(texto: str) -> date:
+    try:
+        return date.fromisoformat(texto)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"data inválida (use AAAA-MM-DD): {texto}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Gera em lote as tabelas de relatório do painel APS a partir das planilhas do e-SUS.")
+    parser.add_argument('pasta', help="Pasta com as planilhas .xlsx (cidadãos, domicílios e produtividade)")
+    parser.add_argument('--saida', default='relatorios', help="Pasta de saída (padrão: relatorios)")
+    parser.add_argument('--municipio', help="Trata todas as planilhas como deste município, em vez de identificá-lo pelo nome do arquivo")
+    parser.add_argument('--formato', choices=['xlsx', 'csv'], default='xlsx', help="Formato das tabelas (padrão: xlsx)")
+    parser.add_argument('--inicio', type=_data, help="Início do período da produção (AAAA-MM-DD)")
+    parser.add_argument('--fim', type=_data, help="Fim do período da produção (AAAA-MM-DD)")
+    args = parser.parse_args(argv)
+
+    if (args.inicio is None) != (args.fim is None): parser.error("--inicio e --fim devem ser usados juntos")
+    if not os.path.isdir(args.pasta): parser.error(f"pasta não encontrada: {args.pasta}")
+
+    df_parametros = tabela_parametros()
+    municipios = sorted(df_parametros['MUNICIPIO'].unique())
+    municipio_fixo = None
+    if args.municipio:
+        municipio_fixo = inferir_municipio([args.municipio], municipios)
+        if municipio_fixo is None: parser.error(f"município sem parâmetros cadastrados: {args.municipio}")
+
+    grupos = _agrupar_por_municipio(_listar_planilhas(args.pasta), municipios, municipio_fixo)
+    if not grupos:
+        print("Nenhuma planilha de município conhecido foi encontrada.")
+        return 1
+
+    periodo = (args.inicio, args.fim) if args.inicio else None
+    for municipio, caminhos in grupos.items():
+        dados = _ler_planilhas(caminhos)
+        df_prod = dados.get(TIPO_PRODUTIVIDADE)
+        if periodo and df_prod is not None and 'DATA' not in df_prod.columns:
+            print(f"Aviso: {municipio}: a planilha de produtividade não tem a coluna 'DATA'; o período foi ignorado.")
+        relatorios = gerar_relatorios(
+            parametros_do_municipio(df_parametros, municipio), df_cid=dados.get(TIPO_CIDADAOS),
+            df_dom=dados.get(TIPO_DOMICILIOS), df_prod=df_prod, periodo=periodo
+        )
+        pasta_municipio = os.path.join(args.saida, municipio)
+        os.makedirs(pasta_municipio, exist_ok=True)
+        for nome, tabela in relatorios.items():
+            _gravar_tabela(tabela, pasta_municipio, nome, args.formato)
+        print(f"{municipio}: {len(caminhos)} planilha(s), {len(relatorios)} tabela(s) em {pasta_municipio}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,362 @@
+"""
+Leitura e normalização das planilhas exportadas pelo e-SUS (cidadãos, domicílios
+e produtividade).
+
+Este módulo não depende do Streamlit: as funções aqui precisam ser importáveis
+pelos processos auxiliares que leem vários uploads em paralelo.
+"""
+
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Any, Dict, List, Optional, Tuple
+
+import openpyxl
+import pandas as pd
+from pandas._libs.parsers import STR_NA_VALUES
+from pandas.api.types import union_categoricals
+
+# ==============================================================================
+# 1. CONSTANTES
+# ==============================================================================
+
+COL_STATUS_DOC = 'STATUS DOCUMENTO'
+COL_TEMPO_SEM_ATUALIZAR = 'TEMPO SEM ATUALIZAR'
+COL_UNIDADE = 'UNIDADE DE SAÚDE'
+COL_NOME_EQUIPE = 'NOME EQUIPE'
+COL_INE = 'INE'
+COL_CIDADAO = 'CIDADÃO'
+COL_EQUIPE_COMPLETA = 'EQUIPE_COMPLETA'
+COL_FAMILIA_VINCULADA = 'TEM FAMÍLIA VÍNCULADA?'
+DOM_COL_UNIDADE = 'Estabelecimento'
+
+ABA_DETALHADO = 'DETALHADO'
+COLUNAS_CIDADAOS = [COL_STATUS_DOC, COL_TEMPO_SEM_ATUALIZAR, COL_UNIDADE, COL_NOME_EQUIPE, COL_INE, COL_CIDADAO]
+COLUNAS_DOMICILIOS = [DOM_COL_UNIDADE, COL_INE, COL_TEMPO_SEM_ATUALIZAR, COL_FAMILIA_VINCULADA]
+TIPO_CIDADAOS, TIPO_DOMICILIOS, TIPO_PRODUTIVIDADE = 'cidadaos', 'domicilios', 'produtividade'
+
+# Cache persistente (Parquet) das planilhas já normalizadas, endereçado pelo SHA-256 do arquivo
+DIRETORIO_CACHE = os.environ.get('APS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache_planilhas'))
+VERSAO_CACHE = 4  # incrementar sempre que a normalização das planilhas mudar
+# Retenção do cache em disco (ele guarda dados pessoais dos cidadãos): tamanho máximo e dias sem uso
+LIMITE_CACHE_MB = int(os.environ.get('APS_CACHE_MB', 2048))
+VALIDADE_CACHE_DIAS = int(os.environ.get('APS_CACHE_DIAS', 30))
+
+# Perfil de tipos aplicado após a leitura: colunas de texto repetitivo viram categorias
+COLUNAS_CATEGORICAS: Dict[str, List[str]] = {
+    TIPO_CIDADAOS: [COL_UNIDADE, COL_NOME_EQUIPE, COL_EQUIPE_COMPLETA, COL_TEMPO_SEM_ATUALIZAR, COL_STATUS_DOC],
+    TIPO_DOMICILIOS: ['ESTABELECIMENTO_COMPLETO', COL_TEMPO_SEM_ATUALIZAR, COL_FAMILIA_VINCULADA],
+    TIPO_PRODUTIVIDADE: ['ESTABELECIMENTO', 'EQUIPE', 'DESCRIÇÃO DO CBO', 'TIPO DE ATENDIMENTO'],
+}
+
+# Nº de processos para ler uploads múltiplos (padrão: nº de CPUs, até 4; cada processo carrega o pandas e o openpyxl)
+PROCESSOS_LEITURA = int(os.environ.get('APS_PROCESSOS_LEITURA', min(4, os.cpu_count() or 1)))
+# Segundos sem leituras até o pool ser encerrado (os processos não ficam ocupando memória entre uploads)
+POOL_OCIOSO_SEGUNDOS = int(os.environ.get('APS_POOL_OCIOSO', 300))
+
+# Resultado da leitura de um arquivo: (tipo, df, mensagem de erro)
+ResultadoLeitura = Tuple[Optional[str], Optional[pd.DataFrame], Optional[str]]
+
+# ==============================================================================
+# 2. CLASSIFICAÇÃO E LEITURA EM STREAMING
+# ==============================================================================
+
+def hash_conteudo(conteudo: bytes) -> str:
+    return hashlib.sha256(conteudo).hexdigest()
+
+def _ler_cabecalho(ws) -> List[str]:
+    linha = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+    return [str(c).strip() for c in linha if c is not None]
+
+def classificar_planilha(conteudo: bytes) -> Optional[str]:
+    """
+    Identifica o tipo de relatório (cidadãos, domicílios ou produtividade) lendo
+    apenas os nomes das abas e a linha de cabeçalho, sem carregar os dados.
+    Segue a mesma ordem de tentativa da leitura completa: cidadãos, domicílios
+    e, por fim, produtividade (primeira aba com a coluna 'EQUIPE').
+    """
+    try:
+        wb = openpyxl.load_workbook(io.BytesIO(conteudo), read_only=True, data_only=True)
+    except Exception:
+        return None
+    try:
+        if ABA_DETALHADO in wb.sheetnames:
+            cabecalho = set(_ler_cabecalho(wb[ABA_DETALHADO]))
+            if cabecalho.issuperset(COLUNAS_CIDADAOS): return TIPO_CIDADAOS
+            if cabecalho.issuperset(COLUNAS_DOMICILIOS): return TIPO_DOMICILIOS
+        if wb.worksheets and 'EQUIPE' in _ler_cabecalho(wb.worksheets[0]): return TIPO_PRODUTIVIDADE
+        return None
+    finally:
+        wb.close()
+
+def _valor_celula(valor: Any) -> Any:
+    # Mesma conversão do pandas: números inteiros gravados como float voltam a ser int
+    if isinstance(valor, float) and valor.is_integer(): return int(valor)
+    # e os textos que o pd.read_excel lê como ausentes ('', 'NA', 'N/A', 'NULL', '#N/A', 'nan'...)
+    if isinstance(valor, str) and valor in STR_NA_VALUES: return None
+    return valor
+
+def _coluna_tipada(valores: List[Any]) -> pd.Series:
+    # Reproduz a inferência do pd.read_excel: textos numéricos (ex.: INE) viram números
+    serie = pd.Series(valores, dtype=object)
+    try:
+        return pd.to_numeric(serie)
+    except (ValueError, TypeError):
+        return serie.infer_objects()
+
+def ler_colunas_detalhado(conteudo: bytes, colunas: List[str]) -> Optional[pd.DataFrame]:
+    """
+    Lê a aba DETALHADO em streaming (openpyxl read-only), materializando apenas
+    as `colunas` pedidas. O pico de memória passa a depender das colunas
+    projetadas, e não da largura total da planilha exportada pelo e-SUS.
+    Retorna None se alguma das colunas não existir no cabeçalho.
+    """
+    wb = openpyxl.load_workbook(io.BytesIO(conteudo), read_only=True, data_only=True)
+    try:
+        linhas = wb[ABA_DETALHADO].iter_rows(values_only=True)
+        cabecalho = [str(c).strip() if c is not None else None for c in next(linhas, ())]
+        if not all(c in cabecalho for c in colunas): return None
+        indices = [cabecalho.index(c) for c in colunas]
+        valores: List[List[Any]] = [[] for _ in colunas]
+        for linha in linhas:
+            if all(v is None for v in linha): continue  # pandas também descarta linhas em branco
+            n = len(linha)
+            for destino, i in zip(valores, indices):
+                destino.append(_valor_celula(linha[i]) if i < n else None)
+    finally:
+        wb.close()
+    return pd.DataFrame({c: _coluna_tipada(v) for c, v in zip(colunas, valores)})
+
+def ler_planilha_cidadaos(conteudo: bytes) -> Optional[pd.DataFrame]:
+    df = ler_colunas_detalhado(conteudo, COLUNAS_CIDADAOS)
+    if df is None: return None
+    df = df.dropna(subset=[COL_UNIDADE, COL_NOME_EQUIPE, COL_INE, COL_CIDADAO])
+    df[COL_TEMPO_SEM_ATUALIZAR] = df[COL_TEMPO_SEM_ATUALIZAR].str.upper()
+    df[COL_STATUS_DOC] = df[COL_STATUS_DOC].str.upper()
+    df[COL_INE] = df[COL_INE].astype(str).str.strip()
+    df[COL_EQUIPE_COMPLETA] = df[COL_NOME_EQUIPE].str.strip() + ' - ' + df[COL_INE]
+    return df
+
+def ler_planilha_domicilios(conteudo: bytes) -> Optional[pd.DataFrame]:
+    df = ler_colunas_detalhado(conteudo, COLUNAS_DOMICILIOS)
+    if df is None: return None
+    df['INE'] = df['INE'].astype(str)
+    df['ESTABELECIMENTO_COMPLETO'] = df[DOM_COL_UNIDADE] + ' - ' + df['INE']
+    return df[['ESTABELECIMENTO_COMPLETO', COL_TEMPO_SEM_ATUALIZAR, COL_FAMILIA_VINCULADA]].copy()
+
+def ler_planilha_produtividade(conteudo: bytes) -> Optional[pd.DataFrame]:
+    df = pd.read_excel(io.BytesIO(conteudo))
+    df.columns = df.columns.str.strip()
+    if 'EQUIPE' not in df.columns: return None
+    if 'DATA' in df.columns: df['DATA'] = pd.to_datetime(df['DATA'], errors='coerce')
+    return df
+
+LEITORES = {
+    TIPO_CIDADAOS: ler_planilha_cidadaos,
+    TIPO_DOMICILIOS: ler_planilha_domicilios,
+    TIPO_PRODUTIVIDADE: ler_planilha_produtividade,
+}
+
+# ==============================================================================
+# 3. PERFIL DE TIPOS (MEMÓRIA)
+# ==============================================================================
+
+def aplicar_perfil_tipos(df: pd.DataFrame, tipo: str) -> pd.DataFrame:
+    """
+    Converte as colunas de texto repetitivo em categorias (com categorias em ordem
+    alfabética, para que groupby/crosstab mantenham a ordem de antes), reduz
+    'TOTAL GERAL' para int32 e guarda o INE como inteiro.
+    """
+    for col in COLUNAS_CATEGORICAS[tipo]:
+        if col in df.columns: df[col] = df[col].astype('category')
+    if COL_INE in df.columns:
+        # O INE em texto continua disponível em EQUIPE_COMPLETA, usada na busca de parâmetros
+        df[COL_INE] = pd.to_numeric(df[COL_INE], errors='coerce').astype('Int64')
+    total = df.get('TOTAL GERAL')
+    if total is not None and pd.api.types.is_numeric_dtype(total) and total.notna().all() and (total % 1 == 0).all():
+        # int32 e não int8/int16: o groupby().sum() preserva o tipo e estouraria nas somas por unidade/equipe
+        if total.abs().max() < 2**31: df['TOTAL GERAL'] = total.astype('int32')
+    return ordenar_por_data(df)
+
+def ordenar_por_data(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ordena a produção pela 'DATA' (ordenação estável, datas vazias no fim), para
+    que o filtro de período seja uma busca binária. Sem 'DATA', nada muda.
+    """
+    if 'DATA' not in df.columns: return df
+    return df.sort_values('DATA', kind='stable', na_position='last', ignore_index=True)
+
+def concatenar_planilhas(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    pd.concat que preserva as colunas categóricas: as categorias de cada arquivo
+    são unificadas antes, senão o pandas voltaria a coluna para 'object'.
+    """
+    if len(frames) > 1:
+        categoricas = [c for c in frames[0].columns
+                       if all(c in f.columns and isinstance(f[c].dtype, pd.CategoricalDtype) for f in frames)]
+        for col in categoricas:
+            categorias = union_categoricals([f[col] for f in frames], sort_categories=True).categories
+            frames = [f.assign(**{col: f[col].cat.set_categories(categorias)}) for f in frames]
+        return ordenar_por_data(pd.concat(frames, ignore_index=True))
+    return pd.concat(frames, ignore_index=True)
+
+# ==============================================================================
+# 4. CACHE EM DISCO (PARQUET)
+# ==============================================================================
+
+def _caminho_cache(digest: str, tipo: str) -> str:
+    return os.path.join(DIRETORIO_CACHE, f"{digest}.{tipo}.v{VERSAO_CACHE}.parquet")
+
+def existe_cache_parquet(digest: str) -> bool:
+    return any(os.path.exists(_caminho_cache(digest, tipo)) for tipo in LEITORES)
+
+def ler_cache_parquet(digest: str) -> Tuple[Optional[str], Optional[pd.DataFrame]]:
+    """Procura no cache em disco o resultado normalizado de uma planilha. Retorna (tipo, df) ou (None, None)."""
+    for tipo in LEITORES:
+        caminho = _caminho_cache(digest, tipo)
+        if not os.path.exists(caminho): continue
+        try:
+            df = pd.read_parquet(caminho)
+            os.utime(caminho)  # a data de modificação marca o último uso (retenção em limpar_cache_parquet)
+            return tipo, df
+        except Exception as e:
+            print(f"Aviso: cache corrompido ignorado ({caminho}): {e}")
+    return None, None
+
+def gravar_cache_parquet(df: pd.DataFrame, digest: str, tipo: str) -> None:
+    """Grava o DataFrame normalizado no cache em disco. Falhas não interrompem a análise."""
+    caminho = _caminho_cache(digest, tipo)
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(DIRETORIO_CACHE, exist_ok=True)
+        df.to_parquet(temporario, index=False)
+        os.replace(temporario, caminho)  # escrita atômica: outra sessão nunca lê um arquivo pela metade
+    except Exception as e:
+        print(f"Aviso: não foi possível gravar o cache da planilha ({tipo}): {e}")
+        if os.path.exists(temporario): os.remove(temporario)
+    limpar_cache_parquet()
+
+def limpar_cache_parquet() -> None:
+    """
+    Remove do cache em disco os arquivos de versões anteriores, os sem uso há mais
+    de VALIDADE_CACHE_DIAS e, se ainda passar de LIMITE_CACHE_MB, os usados há
+    mais tempo. Temporários de gravações interrompidas saem depois de um dia.
+    """
+    sufixo = f".v{VERSAO_CACHE}.parquet"
+    agora = time.time()
+    arquivos = []
+    try:
+        with os.scandir(DIRETORIO_CACHE) as entradas:
+            for entrada in entradas:
+                if not entrada.is_file(): continue
+                info = entrada.stat()
+                idade = agora - info.st_mtime
+                antigo = idade > VALIDADE_CACHE_DIAS * 86400 or (entrada.name.endswith('.tmp') and idade > 86400)
+                if antigo or (entrada.name.endswith('.parquet') and not entrada.name.endswith(sufixo)): _remover_cache(entrada.path)
+                elif entrada.name.endswith(sufixo): arquivos.append((info.st_mtime, info.st_size, entrada.path))
+    except OSError:
+        return
+    excesso = sum(tamanho for _, tamanho, _ in arquivos) - LIMITE_CACHE_MB * 1024 * 1024
+    for _, tamanho, caminho in sorted(arquivos):
+        if excesso <= 0: break
+        _remover_cache(caminho)
+        excesso -= tamanho
+
+def _remover_cache(caminho: str) -> None:
+    try:
+        os.remove(caminho)
+    except OSError:
+        pass  # outro processo já removeu
+
+# ==============================================================================
+# 5. PROCESSAMENTO DE UPLOADS (SEQUENCIAL OU EM PARALELO)
+# ==============================================================================
+
+def processar_planilha(digest: str, conteudo: bytes) -> ResultadoLeitura:
+    """
+    Devolve (tipo, df, erro) de um arquivo: consulta o cache em disco e, na falta
+    dele, classifica pelo cabeçalho e faz uma única leitura completa. Erros são
+    devolvidos como texto para serem exibidos na ordem dos uploads.
+    """
+    tipo, df = ler_cache_parquet(digest)
+    if df is not None: return tipo, df, None
+    tipo = classificar_planilha(conteudo)
+    if tipo is None: return None, None, None
+    try:
+        df = LEITORES[tipo](conteudo)
+    except Exception as e:
+        # Só a planilha de cidadãos reportava falhas de leitura; as demais são ignoradas
+        return None, None, (f"Erro ao ler planilha de cidadãos: {e}" if tipo == TIPO_CIDADAOS else None)
+    if df is None: return None, None, None
+    df = aplicar_perfil_tipos(df, tipo)
+    gravar_cache_parquet(df, digest, tipo)
+    return tipo, df, None
+
+def _processar_planilha_item(item: Tuple[str, bytes]) -> ResultadoLeitura:
+    return processar_planilha(*item)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_pool_em_uso = 0  # lotes usando o pool agora
+_pool_encerramento: Optional[threading.Timer] = None
+
+def _obter_pool() -> ProcessPoolExecutor:
+    # Pool compartilhado por todas as sessões; "spawn" evita herdar as threads do servidor
+    global _pool, _pool_em_uso
+    with _pool_lock:
+        if _pool_encerramento is not None: _pool_encerramento.cancel()
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PROCESSOS_LEITURA, mp_context=get_context('spawn'))
+        _pool_em_uso += 1
+        return _pool
+
+def _liberar_pool() -> None:
+    """Fim de um lote: sem outros lotes em andamento, o pool é encerrado após POOL_OCIOSO_SEGUNDOS."""
+    global _pool_em_uso, _pool_encerramento
+    with _pool_lock:
+        _pool_em_uso -= 1
+        if _pool_em_uso > 0 or _pool is None: return
+        _pool_encerramento = threading.Timer(POOL_OCIOSO_SEGUNDOS, _encerrar_pool_ocioso)
+        _pool_encerramento.daemon = True
+        _pool_encerramento.start()
+
+def _encerrar_pool_ocioso() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool_em_uso > 0 or _pool is None: return
+        _pool.shutdown(wait=False)
+        _pool = None
+
+def _descartar_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None: _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def processar_planilhas(itens: List[Tuple[str, bytes]]) -> List[ResultadoLeitura]:
+    """
+    Processa vários arquivos (digest, conteúdo) em paralelo num pool de processos,
+    já que a leitura de xlsx é limitada por CPU e pelo GIL. Os resultados saem na
+    mesma ordem da entrada. Com um único arquivo (ou pool indisponível), lê no
+    próprio processo.
+    """
+    if len(itens) <= 1 or PROCESSOS_LEITURA <= 1:
+        return [_processar_planilha_item(item) for item in itens]
+    try:
+        pool = _obter_pool()
+    except OSError as e:
+        print(f"Aviso: pool de leitura indisponível, processando sequencialmente: {e}")
+        return [_processar_planilha_item(item) for item in itens]
+    try:
+        return list(pool.map(_processar_planilha_item, itens))
+    except (BrokenProcessPool, OSError) as e:
+        print(f"Aviso: pool de leitura indisponível, processando sequencialmente: {e}")
+        _descartar_pool()
+        return [_processar_planilha_item(item) for item in itens]
+    finally:
+        _liberar_pool()
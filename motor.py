@@ -0,0 +1,389 @@
+"""
+Motor de análise do painel APS: parâmetros dos municípios, vínculos, tabelas de
+contagem, cubos de produção e consolidados de atendimento.
+
+Este módulo não depende do Streamlit: é usado tanto pelo painel (app.py) quanto
+pela geração de relatórios em lote (gerar_relatorios.py).
+"""
+
+import os
+import unicodedata
+from datetime import date, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from ingestao import COL_CIDADAO, COL_EQUIPE_COMPLETA, COL_FAMILIA_VINCULADA, COL_STATUS_DOC, COL_TEMPO_SEM_ATUALIZAR, COL_UNIDADE
+
+# ==============================================================================
+# 1. CONSTANTES
+# ==============================================================================
+
+ORDEM_TEMPO = ['ATÉ 4 MESES', '5 A 12 MESES', '13 A 24 MESES', 'MAIS DE 2 ANOS']
+ORDEM_CPF = ['COM CPF', 'SEM CPF']
+
+# Agrupamento dos tipos de atendimento da ESF
+CATEGORIAS_ATENDIMENTO: Dict[str, str] = {
+    'CONSULTA AGENDADA': 'Cuidado Programado',
+    'CONSULTA AGENDADA PROGRAMADA / CUIDADO CONTINUADO': 'Cuidado Programado',
+    'CONSULTA NO DIA': 'Demanda Espontânea',
+    'ATENDIMENTO DE URGÊNCIA': 'Demanda Espontânea',
+    'ESCUTA INICIAL / ORIENTAÇÃO': 'Outros'
+}
+
+# Tipos de consulta da ESB, na ordem das colunas da tabela
+CATEGORIAS_CONSULTA_ESB = ["Consulta de manutenção em odontologia", "Consulta de retorno em odontologia", "Não informado", "Primeira consulta odontológica programática "]
+
+# Dimensões do cubo de produção (além do dia)
+COLUNAS_CUBO_PRODUCAO = ['ESTABELECIMENTO', 'EQUIPE', 'DESCRIÇÃO DO CBO', 'PROFISSIONAL']
+
+TAMANHO_BLOCO_EXPORTACAO = 20_000
+LINHAS_MAXIMAS_XLSX = 1_048_576  # limite de linhas de uma planilha do Excel (com o cabeçalho)
+
+# ==============================================================================
+# 2. PARÂMETROS DOS MUNICÍPIOS
+# ==============================================================================
+
+# !!!! ATENÇÃO !!!!
+# É CRÍTICO que você edite a seção `eap_por_ine` abaixo, substituindo
+# os INEs de exemplo pelos INEs REAIS das suas equipes EAP.
+PARAMETROS_POR_MUNICIPIO: Dict[str, Dict[str, Any]] = {
+    # --- MUNICÍPIOS COM EQUIPES EAP (CONFIGURAR AQUI) ---
+    'ALHANDRA-PB':            {'parametro_esf': 2500, 'limite_esf': 3750, 'eap_por_ine': {
+                                  '0009999': {'tipo': '30', 'parametro': 1875, 'limite_maximo': 2813} # SUBSTITUIR PELO INE REAL
+                              }},
+    'MACAÍBA-RN':             {'parametro_esf': 2750, 'limite_esf': 4125, 'eap_por_ine': {
+                                  '0001234': {'tipo': '20', 'parametro': 1375, 'limite_maximo': 2063}, # SUBSTITUIR PELO INE REAL
+                                  '0005678': {'tipo': '30', 'parametro': 1875, 'limite_maximo': 2813}  # SUBSTITUIR PELO INE REAL
+                              }},
+    'VALENÇA-RJ':             {'parametro_esf': 2750, 'limite_esf': 4125, 'eap_por_ine': {
+                                  '0004321': {'tipo': '20', 'parametro': 1375, 'limite_maximo': 2063} # SUBSTITUIR PELO INE REAL
+                              }},
+
+    # --- MUNICÍPIOS APENAS COM EQUIPES ESF ---
+    'ÁGUA PRETA-PE':          {'parametro_esf': 2500, 'limite_esf': 3750},
+    'ÁGUAS BELAS-PE':         {'parametro_esf': 2500, 'limite_esf': 3750},
+    'ALTO DO RODRIGUES-RN':   {'parametro_esf': 2000, 'limite_esf': 3000},
+    'APODI-RN':               {'parametro_esf': 2500, 'limite_esf': 3750},
+    'ARAPONGA-MG':            {'parametro_esf': 2000, 'limite_esf': 3000},
+    'AREIA-PB':               {'parametro_esf': 2500, 'limite_esf': 3750},
+    'AÇU-RN':                 {'parametro_esf': 2750, 'limite_esf': 4125},
+    'BRUMADO-BA':             {'parametro_esf': 2750, 'limite_esf': 4125},
+    'CAAPORÃ-PB':             {'parametro_esf': 2500, 'limite_esf': 3750},
+    'CALDAS BRANDÃO-PB':      {'parametro_esf': 2000, 'limite_esf': 3000},
+    'CANAÃ-MG':               {'parametro_esf': 2000, 'limite_esf': 3000},
+    'CARNAUBAIS-RN':          {'parametro_esf': 2000, 'limite_esf': 3000},
+    'CONDE-PB':               {'parametro_esf': 2500, 'limite_esf': 3750},
+    'CORDEIRO-RJ':            {'parametro_esf': 2500, 'limite_esf': 3750},
+    'FERNANDO PEDROZA-RN':    {'parametro_esf': 2000, 'limite_esf': 3000},
+    'GROSSOS-RN':             {'parametro_esf': 2000, 'limite_esf': 3000},
+    'GUARABIRA-PB':           {'parametro_esf': 2750, 'limite_esf': 4125},
+    'ITABAIANA-PB':           {'parametro_esf': 2500, 'limite_esf': 3750},
+    'ITAPOROROCA-PB':         {'parametro_esf': 2000, 'limite_esf': 3000},
+    'ITATUBA-PB':             {'parametro_esf': 2000, 'limite_esf': 3000},
+    'MOGEIRO-PB':             {'parametro_esf': 2000, 'limite_esf': 3000},
+    'PATU-RN':                {'parametro_esf': 2000, 'limite_esf': 3000},
+    'PITIMBU-PB':             {'parametro_esf': 2000, 'limite_esf': 3000},
+    'PAULA CÂNDIDO-MG':       {'parametro_esf': 2000, 'limite_esf': 3000},
+    'PEDRO VELHO-RN':         {'parametro_esf': 2000, 'limite_esf': 3000},
+    'PENDÊNCIAS-RN':          {'parametro_esf': 2000, 'limite_esf': 3000},
+    'POÇO BRANCO-RN':         {'parametro_esf': 2000, 'limite_esf': 3000},
+    'SANTA RITA-PB':          {'parametro_esf': 3000, 'limite_esf': 4500},
+    'SÃO JOSÉ DE UBÁ-RJ':     {'parametro_esf': 2000, 'limite_esf': 3000},
+    'SÃO MIGUEL DO ANTA-MG':  {'parametro_esf': 2000, 'limite_esf': 3000},
+    'TIBAU-RN':               {'parametro_esf': 2000, 'limite_esf': 3000},
+    'VIÇOSA-MG':              {'parametro_esf': 2750, 'limite_esf': 4125},
+    'VIÇOSA DO CEARÁ-CE':     {'parametro_esf': 2750, 'limite_esf': 4125},
+}
+
+def normalizar_texto(text: str) -> str:
+    if not isinstance(text, str): return ""
+    return unicodedata.normalize("NFKD", text).encode("ASCII", "ignore").decode().upper().strip()
+
+def tabela_parametros() -> pd.DataFrame:
+    """
+    Parâmetros de todos os municípios, um por linha. A identificação de equipes
+    EAP é feita pelo NÚMERO DE INE para máxima precisão.
+    """
+    data_list = []
+    for municipio_uf, params in PARAMETROS_POR_MUNICIPIO.items():
+        try:
+            nome, uf = municipio_uf.rsplit('-', 1)
+            row = {
+                'MUNICIPIO': nome, 'UF': uf,
+                'PARAMETRO_ESF': params['parametro_esf'],
+                'LIMITE_ESF': params['limite_esf'],
+                'EAP_POR_INE': params.get('eap_por_ine', {})
+            }
+            data_list.append(row)
+        except ValueError:
+            print(f"Aviso: Chave de município mal formatada e ignorada: {municipio_uf}")
+    return pd.DataFrame(data_list)
+
+def inferir_municipio(nomes_arquivos: Iterable[str], municipios: Iterable[str]) -> Optional[str]:
+    """Primeiro município cujo nome completo aparece no nome de um dos arquivos."""
+    map_norm = {normalizar_texto(m): m for m in municipios}
+    for nome in nomes_arquivos:
+        nome_arquivo = normalizar_texto(os.path.basename(nome))
+        for key, original in map_norm.items():
+            if key in nome_arquivo: return original
+    return None
+
+def parametros_do_municipio(df_parametros: pd.DataFrame, municipio: str) -> Dict[str, Any]:
+    """Linha de parâmetros do município como dicionário (chaves: colunas de `tabela_parametros`)."""
+    return df_parametros.query("MUNICIPIO == @municipio").iloc[0].to_dict()
+
+# ==============================================================================
+# 3. TABELAS DE CONTAGEM
+# ==============================================================================
+
+def crosstab_observado(index: pd.Series, columns: pd.Series) -> pd.DataFrame:
+    """
+    pd.crosstab que ignora categorias sem ocorrência. Com colunas categóricas o
+    pandas inclui todas as categorias (linhas/colunas zeradas); aqui o resultado
+    fica igual ao de colunas de texto.
+    """
+    return remover_vazios(pd.crosstab(index, columns))
+
+def remover_vazios(tab: pd.DataFrame) -> pd.DataFrame:
+    """Remove de uma tabela de contagens as chaves vazias (NaN) e as linhas/colunas zeradas."""
+    tab = tab.loc[tab.index.notna(), tab.columns.notna()]
+    return tab.loc[tab.sum(axis=1) > 0, tab.sum(axis=0) > 0]
+
+def tabela_categorias(tab: pd.DataFrame, ordem: List[str]) -> pd.DataFrame:
+    """Tabela grupo × categoria com as colunas em `ordem` e a coluna 'Total', do maior para o menor."""
+    for cat in ordem:
+        if cat not in tab.columns: tab[cat] = 0
+    tab = tab[ordem]
+    tab['Total'] = tab.sum(axis=1)
+    return tab.sort_values('Total', ascending=False)
+
+# ==============================================================================
+# 4. CIDADÃOS E VÍNCULOS
+# ==============================================================================
+
+def montar_cubo_cidadaos(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Series, int]:
+    """
+    Cubo de contagens dos cidadãos por unidade × equipe × tempo sem atualizar ×
+    situação do CPF. `linhas` conta registros e `cidadaos` os registros com o
+    cidadão preenchido. Os cidadãos distintos (por unidade e no total) não são
+    somáveis e saem à parte.
+    """
+    dims = [COL_UNIDADE, COL_EQUIPE_COMPLETA, COL_TEMPO_SEM_ATUALIZAR, COL_STATUS_DOC]
+    cubo = df.groupby(dims, observed=True, dropna=False)[COL_CIDADAO].agg(linhas='size', cidadaos='count')
+    unicos_por_unidade = df.groupby(COL_UNIDADE, observed=True)[COL_CIDADAO].nunique()
+    return cubo, unicos_por_unidade, df[COL_CIDADAO].nunique()
+
+def filtrar_cubo_cidadaos(cubo: pd.DataFrame, unidade: str) -> pd.DataFrame:
+    if unidade == 'Todas': return cubo
+    return cubo[cubo.index.get_level_values(COL_UNIDADE) == unidade]
+
+def tabela_parametros_ine(parametros: Dict[str, Any]) -> pd.DataFrame:
+    """Tabela dos parâmetros das equipes EAP do município, indexada pelo INE."""
+    eap_map = parametros.get('EAP_POR_INE', {})
+    tabela = pd.DataFrame.from_dict(eap_map, orient='index', columns=['tipo', 'parametro', 'limite_maximo'])
+    return tabela.rename(columns={'tipo': 'Tipo de Equipe', 'parametro': 'Parametro_Equipe', 'limite_maximo': 'Limite_Equipe'})
+
+def calcular_vinculos(cubo: pd.DataFrame, parametros: Dict[str, Any]) -> pd.DataFrame:
+    """Calcula vínculos a partir do cubo de cidadãos, identifica tipo de equipe via INE e formata os dados."""
+    vinculos_df = cubo.groupby(level=[COL_UNIDADE, COL_EQUIPE_COMPLETA], observed=True)['cidadaos'].sum().reset_index()
+    vinculos_df.columns = ['Unidade de Saúde', 'Equipe Original', 'Nº de Pessoas Vinculadas']
+    vinculos_df = vinculos_df.astype({'Unidade de Saúde': object, 'Equipe Original': object})
+
+    vinculos_df['INE'] = vinculos_df['Equipe Original'].str.split(' - ').str[-1].str.strip()
+
+    # Equipes sem parâmetro próprio (fora do mapa EAP) recebem os parâmetros de ESF do município
+    vinculos_df = vinculos_df.join(tabela_parametros_ine(parametros), on='INE')
+    vinculos_df['Tipo de Equipe'] = vinculos_df['Tipo de Equipe'].astype(object).fillna('ESF')
+    vinculos_df['Parametro_Equipe'] = vinculos_df['Parametro_Equipe'].fillna(parametros['PARAMETRO_ESF']).astype('int64')
+    vinculos_df['Limite_Equipe'] = vinculos_df['Limite_Equipe'].fillna(parametros['LIMITE_ESF']).astype('int64')
+
+    pessoas = vinculos_df['Nº de Pessoas Vinculadas']
+    vinculos_df['Status'] = np.select(
+        [pessoas > vinculos_df['Limite_Equipe'], pessoas > vinculos_df['Parametro_Equipe']],
+        ['🚨 ACIMA DO LIMITE MÁXIMO', '⚠️ Acima do Parâmetro'],
+        default='✅ Dentro do Parâmetro'
+    ).astype(object)
+
+    tipo = vinculos_df['Tipo de Equipe'].astype(str)
+    tipo_sigla = ('EAP ' + tipo).where(tipo.isin(['20', '30']), 'ESF')
+    vinculos_df['Equipe'] = tipo_sigla + ' - ' + vinculos_df['Unidade de Saúde'].astype(str) + ' - ' + vinculos_df['INE']
+
+    return vinculos_df.sort_values('Nº de Pessoas Vinculadas', ascending=False)
+
+def enriquecer_vinculos(df_vinculos: pd.DataFrame) -> pd.DataFrame:
+    """Acrescenta aos vínculos o excedente sobre o limite da equipe e o percentual acima dele."""
+    excedente = (df_vinculos['Nº de Pessoas Vinculadas'] - df_vinculos['Limite_Equipe']).clip(lower=0)
+    return df_vinculos.assign(**{
+        'Excedente': excedente,
+        '% Acima do Limite': ((excedente / df_vinculos['Limite_Equipe']) * 100).apply(lambda x: f"{x:.1f}%" if x > 0 else "N/A")
+    })
+
+def resumo_unidades(df_vinculos: pd.DataFrame) -> pd.DataFrame:
+    """Nº de equipes, de cidadãos e média de cidadãos por equipe em cada unidade."""
+    resumo = df_vinculos.groupby('Unidade de Saúde').agg(
+        N_Equipes=('Equipe Original', 'nunique'),
+        N_Cidadaos=('Nº de Pessoas Vinculadas', 'sum')
+    ).reset_index()
+    resumo['Media_Cidadaos_Equipe'] = resumo['N_Cidadaos'] / resumo['N_Equipes']
+    return resumo.sort_values("N_Cidadaos", ascending=False)
+
+def tabela_cubo_cidadaos(cubo: pd.DataFrame, col_categorica: str, df_vinculos: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Contagem grupo × categoria a partir do cubo, igual ao crosstab dos registros.
+    O grupo é a unidade, ou a equipe (nome de `df_vinculos`) quando os vínculos são passados.
+    """
+    linhas = cubo['linhas']
+    if df_vinculos is not None:
+        mapa_nomes = pd.Series(df_vinculos['Equipe'].values, index=df_vinculos['Equipe Original']).to_dict()
+        grupo = pd.Index(pd.Series(linhas.index.get_level_values(COL_EQUIPE_COMPLETA)).map(mapa_nomes), name='Equipe')
+    else: grupo = linhas.index.get_level_values(COL_UNIDADE)
+    return remover_vazios(linhas.groupby([grupo, linhas.index.get_level_values(col_categorica)], observed=True).sum().unstack(fill_value=0))
+
+# ==============================================================================
+# 5. PRODUÇÃO
+# ==============================================================================
+
+def intervalo_datas(df: pd.DataFrame) -> Optional[Tuple[date, date]]:
+    """Primeira e última data da produção, lidas nas pontas da coluna 'DATA' ordenada."""
+    datas = df['DATA'].to_numpy()
+    n_validas = datas.searchsorted(np.datetime64('NaT'))
+    if n_validas == 0: return None
+    return pd.Timestamp(datas[0]).date(), pd.Timestamp(datas[n_validas - 1]).date()
+
+def fatiar_periodo(df: pd.DataFrame, inicio: date, fim: date) -> pd.DataFrame:
+    """
+    Linhas com 'DATA' entre `inicio` e `fim` (inclusive). A coluna vem ordenada
+    da ingestão (NaT no fim), então basta uma busca binária e uma fatia sem cópia.
+    """
+    limites = [np.datetime64(inicio), np.datetime64(fim + timedelta(days=1))]
+    i, j = df['DATA'].to_numpy().searchsorted(limites)
+    return df.iloc[i:j]
+
+def montar_cubo_producao(df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """
+    Cubo da produção: soma de 'TOTAL GERAL' (e de seus quadrados, usada na cor
+    do treemap) e nº de registros por unidade × equipe × CBO × profissional × dia.
+    """
+    if any(c not in df.columns for c in COLUNAS_CUBO_PRODUCAO + ['TOTAL GERAL']): return None
+    base = df[COLUNAS_CUBO_PRODUCAO + ['TOTAL GERAL']].assign(QUADRADOS=pd.to_numeric(df['TOTAL GERAL'], errors='coerce').astype('float64') ** 2)
+    dims = COLUNAS_CUBO_PRODUCAO
+    if 'DATA' in df.columns:
+        base['DIA'] = df['DATA'].dt.normalize()
+        dims = dims + ['DIA']
+    return base.groupby(dims, observed=True, dropna=False).agg(**{
+        'TOTAL GERAL': ('TOTAL GERAL', 'sum'), 'QUADRADOS': ('QUADRADOS', 'sum'), 'LINHAS': ('TOTAL GERAL', 'size')
+    })
+
+def producao_por_profissional(cubo: pd.DataFrame) -> pd.DataFrame:
+    """Produção (soma de 'TOTAL GERAL') por unidade × equipe × CBO × profissional; profissional vazio vira 'Não Informado'."""
+    tabela = cubo.groupby(level=COLUNAS_CUBO_PRODUCAO, observed=True, dropna=False)['TOTAL GERAL'].sum().reset_index()
+    tabela = tabela.astype({c: object for c in COLUNAS_CUBO_PRODUCAO}).fillna({'PROFISSIONAL': 'Não Informado'})
+    return tabela.sort_values(COLUNAS_CUBO_PRODUCAO[:3] + ['TOTAL GERAL'], ascending=[True, True, True, False], ignore_index=True)
+
+def montar_matriz_tipos(df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """Contagem de atendimentos unidade × tipo de atendimento, mantendo as chaves vazias (NaN)."""
+    if 'ESTABELECIMENTO' not in df.columns or 'TIPO DE ATENDIMENTO' not in df.columns: return None
+    matriz = df.groupby(['ESTABELECIMENTO', 'TIPO DE ATENDIMENTO'], observed=True, dropna=False).size().unstack(fill_value=0)
+    return matriz.rename_axis(index='Unidade de Saúde')
+
+def categorias_dos_tipos(matriz: pd.DataFrame) -> pd.Series:
+    """Categoria (programado, demanda espontânea, outros) de cada coluna da matriz de tipos."""
+    return pd.Series([CATEGORIAS_ATENDIMENTO.get(t) for t in matriz.columns], index=matriz.columns)
+
+def perfil_unidades(matriz: pd.DataFrame) -> pd.DataFrame:
+    """Atendimentos de cada unidade por categoria de atendimento."""
+    matriz_unidades = matriz.loc[matriz.index.notna()]
+    perfil = remover_vazios(matriz_unidades.T.groupby(categorias_dos_tipos(matriz).values).sum().T)
+    return perfil.reindex(columns=['Cuidado Programado', 'Demanda Espontânea', 'Outros'], fill_value=0)
+
+def scorecard_unidades(perfil: pd.DataFrame) -> pd.DataFrame:
+    """Percentuais de cuidado programado e de demanda espontânea e o índice programado/demanda por unidade."""
+    scorecard = perfil.assign(Total=perfil.sum(axis=1))
+    scorecard['% Programado'] = (scorecard['Cuidado Programado'] / scorecard['Total']) * 100
+    scorecard['% Demanda'] = (scorecard['Demanda Espontânea'] / scorecard['Total']) * 100
+    scorecard['Índice Eficiência (Prog/Demanda)'] = scorecard['Cuidado Programado'] / scorecard['Demanda Espontânea']
+    return scorecard[['% Programado', '% Demanda', 'Índice Eficiência (Prog/Demanda)']].sort_values('Índice Eficiência (Prog/Demanda)', ascending=False).fillna(0)
+
+def tabela_tipos_atendimento(matriz: pd.DataFrame) -> pd.DataFrame:
+    """Matriz unidade × tipo de atendimento sem chaves vazias, com a coluna 'Total Geral'."""
+    tabela = remover_vazios(matriz)
+    tabela["Total Geral"] = tabela.sum(axis=1)
+    return tabela
+
+def coluna_tipo_consulta(df: pd.DataFrame) -> Optional[str]:
+    """Nome da coluna 'TIPO DE CONSULTA' da planilha de produtividade (ignorando acentos e caixa)."""
+    return next((c for c in df.columns if normalizar_texto(c) == "TIPO DE CONSULTA"), None)
+
+def tabela_consultas_esb(df: pd.DataFrame, col_tipo_consulta: str) -> pd.DataFrame:
+    """Consultas da ESB por unidade e tipo de consulta, com o total da unidade e a linha 'Total Geral'."""
+    categorias = CATEGORIAS_CONSULTA_ESB
+    tabela = pd.pivot_table(df, values="PROFISSIONAL", index=["ESTABELECIMENTO"], columns=[col_tipo_consulta], aggfunc="count", fill_value=0, observed=True)
+    for cat in categorias:
+        if cat not in tabela.columns: tabela[cat] = 0
+    tabela = tabela[categorias]
+    tabela["Total Unidade"] = tabela.sum(axis=1)
+    total_geral = tabela[categorias].sum().to_frame().T
+    total_geral.index, total_geral["Total Unidade"] = ["Total Geral"], total_geral.sum(axis=1)
+    return pd.concat([tabela, total_geral])
+
+# ==============================================================================
+# 6. ESCRITA DE TABELAS E RELATÓRIOS EM LOTE
+# ==============================================================================
+
+def escrever_xlsx(df: pd.DataFrame, caminho: str, aba: str = "Dados"):
+    """xlsx escrito linha a linha pelo xlsxwriter em modo constant_memory (o XML vai direto ao disco)."""
+    with xlsxwriter.Workbook(caminho, {'constant_memory': True, 'default_date_format': 'dd/mm/yyyy hh:mm'}) as workbook:
+        planilha = workbook.add_worksheet(aba)
+        planilha.write_row(0, 0, [str(c) for c in df.columns])
+        linha = 1
+        for inicio in range(0, len(df), TAMANHO_BLOCO_EXPORTACAO):
+            bloco = df.iloc[inicio:inicio + TAMANHO_BLOCO_EXPORTACAO].astype(object)
+            for valores in bloco.where(bloco.notna(), None).itertuples(index=False, name=None):
+                planilha.write_row(linha, 0, valores)
+                linha += 1
+
+def escrever_csv(df: pd.DataFrame, caminho: str):
+    """CSV (separador ';' e vírgula decimal, como o Excel em português) escrito em blocos."""
+    with open(caminho, 'w', encoding='utf-8-sig', newline='') as arquivo:
+        for inicio in range(0, len(df), TAMANHO_BLOCO_EXPORTACAO):
+            df.iloc[inicio:inicio + TAMANHO_BLOCO_EXPORTACAO].to_csv(arquivo, index=False, header=inicio == 0, sep=';', decimal=',')
+
+def gerar_relatorios(
+    parametros: Dict[str, Any], df_cid: Optional[pd.DataFrame] = None, df_dom: Optional[pd.DataFrame] = None,
+    df_prod: Optional[pd.DataFrame] = None, periodo: Optional[Tuple[date, date]] = None
+) -> Dict[str, pd.DataFrame]:
+    """
+    Todas as tabelas de relatório de um município (as mesmas exportadas pelas abas
+    do painel, sem filtro de unidade), por nome. Tabelas cujos dados não vieram
+    nas planilhas ficam de fora; sem a coluna 'DATA', o `periodo` é ignorado.
+    """
+    relatorios: Dict[str, pd.DataFrame] = {}
+    if df_cid is not None:
+        cubo, _, _ = montar_cubo_cidadaos(df_cid)
+        df_vinculos = calcular_vinculos(cubo, parametros)
+        colunas_vinculos = ['Equipe', 'Nº de Pessoas Vinculadas', 'Tipo de Equipe', 'Status', 'Excedente', '% Acima do Limite', 'Unidade de Saúde']
+        relatorios['analise_vinculos_detalhada'] = enriquecer_vinculos(df_vinculos)[colunas_vinculos]
+        relatorios['resumo_unidades'] = resumo_unidades(df_vinculos)
+        relatorios['tempo_atualizacao_cid'] = tabela_categorias(tabela_cubo_cidadaos(cubo, COL_TEMPO_SEM_ATUALIZAR), ORDEM_TEMPO).reset_index()
+        relatorios['cadastros_cpf'] = tabela_categorias(tabela_cubo_cidadaos(cubo, COL_STATUS_DOC), ORDEM_CPF).reset_index()
+
+    if df_dom is not None and 'ESTABELECIMENTO_COMPLETO' in df_dom.columns:
+        grupo = df_dom['ESTABELECIMENTO_COMPLETO']
+        relatorios['tempo_atualizacao_dom'] = tabela_categorias(crosstab_observado(grupo, df_dom[COL_TEMPO_SEM_ATUALIZAR]), ORDEM_TEMPO).reset_index()
+        ordem_familia = list(df_dom[COL_FAMILIA_VINCULADA].dropna().unique())
+        relatorios['familia_vinculada'] = tabela_categorias(crosstab_observado(grupo, df_dom[COL_FAMILIA_VINCULADA]), ordem_familia).reset_index()
+
+    if df_prod is not None:
+        if periodo and 'DATA' in df_prod.columns: df_prod = fatiar_periodo(df_prod, *periodo)
+        cubo_prod = montar_cubo_producao(df_prod)
+        if cubo_prod is not None: relatorios['producao_por_profissional'] = producao_por_profissional(cubo_prod)
+        matriz = montar_matriz_tipos(df_prod)
+        if matriz is not None:
+            relatorios['tipo_atendimento'] = tabela_tipos_atendimento(matriz).reset_index()
+            relatorios['scorecard_tipo_atendimento'] = scorecard_unidades(perfil_unidades(matriz)).reset_index()
+        col_tipo_consulta = coluna_tipo_consulta(df_prod)
+        if col_tipo_consulta: relatorios['consultas_esb'] = tabela_consultas_esb(df_prod, col_tipo_consulta).reset_index()
+    return relatorios